@@ -0,0 +1,414 @@
+import threading
+import time
+
+import cv2
+import numpy
+from PyQt5.QtGui import QImage
+
+
+class FileCapture(object):
+    """
+    Stand-in for cv2.VideoCapture that plays a video or still image file in a
+    loop, paced like a camera, so that the camera path can be tested and
+    benchmarked without a camera.
+    """
+    def __init__(self, path, fps=None):
+        """
+        Args:
+            path: Filename of a video or an image.
+            fps: Frame rate to deliver frames at, by default that of the
+                video, or 30 for images.
+        """
+        self.path = path
+        self.video = cv2.VideoCapture(path)
+        self.still = None
+        rval, frame = self.video.read()
+        if not rval or self.video.get(cv2.CAP_PROP_FRAME_COUNT) <= 1:
+            # images may open as a sequence of one frame, which cannot be rewound
+            self.video.release()
+            self.video = None
+            self.still = frame if rval else cv2.imread(path)
+        else:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        if fps is None:
+            fps = self.video.get(cv2.CAP_PROP_FPS) if self.video else 0
+        self.fps = fps or 30.0
+        self.props = {}
+        self.due = 0.0
+
+    def isOpened(self):
+        return self.video is not None or self.still is not None
+
+    def read(self, image=None):
+        """
+        Wait for the next frame period, then return the next frame.
+
+        Args:
+            image: Optional array to decode into, like cv2.VideoCapture.read.
+
+        Returns: Tuple (success, BGR numpy array) like cv2.VideoCapture.read.
+        """
+        now = time.perf_counter()
+        if self.due > now:
+            time.sleep(self.due - now)
+        self.due = max(now, self.due) + 1.0 / self.fps
+        if self.still is not None:
+            if image is None or image.shape != self.still.shape:
+                image = numpy.empty_like(self.still)
+            numpy.copyto(image, self.still)
+            return True, image
+        if self.video is None:
+            return False, None
+        rval, frame = self.video.read(image)
+        if not rval:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            rval, frame = self.video.read(image)
+        return rval, frame
+
+    def set(self, prop, value):
+        """
+        Record a capture property; files cannot be reconfigured.
+
+        Returns: False, like cv2.VideoCapture for unsupported properties.
+        """
+        self.props[prop] = value
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if self.video is not None:
+            return self.video.get(prop)
+        if self.still is not None and prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.still.shape[1]
+        if self.still is not None and prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.still.shape[0]
+        return self.props.get(prop, 0.0)
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+        self.video = self.still = None
+
+
+class FrameConverter(object):
+    """
+    Converts captured BGR frames to QImages for display, mirrored as
+    configured, with at most one pass over the pixels. Where Qt can show BGR
+    directly, unmirrored frames are wrapped as they are and mirrored ones are
+    flipped in one go; otherwise the colour swap and flips are done by a
+    single strided copy. Copies go to a buffer reused for every frame.
+    """
+    def __init__(self, invert=""):
+        """
+        Args:
+            invert: "x", "y" or "xy" to mirror frames horizontally, vertically or both.
+        """
+        self.flipX = "x" in invert
+        self.flipY = "y" in invert
+        self.native = hasattr(QImage, "Format_BGR888")
+        self.buffer = None
+        self.array = None
+
+    def convert(self, frame):
+        """
+        Args:
+            frame: H x W x 3 BGR numpy array.
+
+        Returns: QImage sharing memory with the frame or with the buffer, so
+        only valid until the next call; the backing array is held in self.array
+        until then.
+        """
+        if self.native and not (self.flipX or self.flipY) and frame.flags["C_CONTIGUOUS"]:
+            self.array = frame
+        else:
+            if self.buffer is None or self.buffer.shape != frame.shape:
+                self.buffer = numpy.empty_like(frame)
+            if self.native:
+                code = -1 if self.flipX and self.flipY else (1 if self.flipX else 0)
+                cv2.flip(frame, code, dst=self.buffer)
+            else:
+                numpy.copyto(self.buffer, frame[::-1 if self.flipY else 1, ::-1 if self.flipX else 1, ::-1])
+            self.array = self.buffer
+        height, width = self.array.shape[:2]
+        fmt = QImage.Format_BGR888 if self.native else QImage.Format_RGB888
+        return QImage(self.array.data, width, height, self.array.strides[0], fmt)
+
+
+class MotionDetector(object):
+    """
+    Cheap presence sensing: frames are shrunk to a tiny greyscale image and
+    compared against a slowly adapting background. Motion is a large enough
+    share of changed pixels; presence lasts until no motion was seen for a
+    while.
+    """
+    def __init__(self, threshold=0.02, timeout=300.0, size=(32, 24), delta=24, adapt=0.05):
+        """
+        Args:
+            threshold: Fraction of pixels that must change to count as motion.
+            timeout: Seconds without motion after which nobody is present.
+            size: Pixel width and height frames are shrunk to.
+            delta: Grey level difference for a pixel to count as changed.
+            adapt: Weight of each sample in the background, so that lighting
+                changes fade in rather than being taken for motion.
+        """
+        self.threshold = threshold
+        self.timeout = timeout
+        self.size = size
+        self.delta = delta
+        self.adapt = adapt
+        self.background = None
+        self.lastMotion = time.time()
+        self.present = True
+
+    def sample(self, frame, now=None):
+        """
+        Compare a frame with the background.
+
+        Args:
+            frame: H x W x 3 BGR numpy array.
+            now: Time of the frame in seconds, by default now.
+
+        Returns: True if presence changed with this frame.
+        """
+        now = time.time() if now is None else now
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(numpy.float32)
+        if self.background is None:
+            self.background = gray
+            return False
+        changed = numpy.count_nonzero(numpy.abs(gray - self.background) > self.delta)
+        self.background += self.adapt * (gray - self.background)
+        if changed >= self.threshold * gray.size:
+            self.lastMotion = now
+        present = now - self.lastMotion < self.timeout
+        if present != self.present:
+            self.present = present
+            return True
+        return False
+
+
+def negotiateMode(cfg, size, fps):
+    """
+    Choose the capture mode for showing or sensing at a given size and rate,
+    so that no more pixels are captured than are used.
+
+    Args:
+        cfg: Widget configuration, where camera-resolution, camera-fps and
+            camera-fourcc override the choice.
+        size: Pixel width and height the frames are needed at.
+        fps: Frames per second needed.
+
+    Returns: Tuple (width, height, fps, fourcc).
+    """
+    width, height = cfg.get("camera-resolution") or size
+    fps = cfg.get("camera-fps") or fps
+    fourcc = cfg.get("camera-fourcc", "auto")
+    if fourcc == "auto":
+        # raw frames need no decoding, but USB bandwidth limits them to low pixel rates
+        fourcc = "YUYV" if width * height * fps <= cfg.get("camera-yuyv-pixel-rate", 1280 * 720 * 10) else "MJPG"
+    return int(width), int(height), float(fps), fourcc
+
+
+def openCapture(cfg, mode=None):
+    """
+    Open the capture device of a Camera widget, or the file configured as
+    camera-source in its place.
+
+    Args:
+        cfg: Widget configuration.
+        mode: Optional (width, height, fps, fourcc) to request from the device,
+            which picks its closest supported mode.
+
+    Returns: cv2.VideoCapture or FileCapture.
+    """
+    if cfg.get("camera-source"):
+        return FileCapture(cfg["camera-source"], cfg.get("camera-source-fps"))
+    index = cfg.get("camera-index", 0)
+    capture = cv2.VideoCapture(index)
+    if not capture.isOpened():
+        print("Error: cannot open camera", index)
+        return capture
+    capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)
+    if mode:
+        width, height, fps, fourcc = mode
+        # the pixel format limits the available sizes, so it is set first
+        capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        capture.set(cv2.CAP_PROP_FPS, fps)
+        print("Camera {}: {:.0f}x{:.0f} at {:.0f} fps, requested {}x{} at {:.0f} fps {}".format(
+            index, capture.get(cv2.CAP_PROP_FRAME_WIDTH), capture.get(cv2.CAP_PROP_FRAME_HEIGHT),
+            capture.get(cv2.CAP_PROP_FPS), width, height, fps, fourcc))
+    return capture
+
+
+class CaptureThread(threading.Thread):
+    """
+    Opens a capture device and reads frames from it on its own thread, so that
+    neither opening nor waiting for the sensor ever blocks the GUI. Only the newest frame is kept: a frame
+    replaced before it was taken is counted as dropped.
+
+    Frames are read into a small pool of reused arrays. An array is only
+    reused once it was replaced unseen, or once the GUI has taken a newer frame,
+    so the frame on display is never overwritten.
+
+    With a MotionDetector, frames are also sampled for motion every
+    sampleInterval seconds, and capture continues at that rate while paused.
+    """
+    def __init__(self, opener, metrics=None, detector=None, sampleInterval=0.5, onPresence=None, warmup=5,
+                 previous=None):
+        """
+        Args:
+            opener: Function returning an opened cv2.VideoCapture or FileCapture,
+                called on the thread; the device is released when it ends.
+            metrics: Optional Metrics to record read times and dropped frames in.
+            detector: Optional MotionDetector to sample frames with.
+            sampleInterval: Seconds between motion samples.
+            onPresence: Function called with True or False from the capture
+                thread when presence changes.
+            warmup: Number of frames to discard after opening, while exposure settles.
+            previous: Optional stopped CaptureThread of the same device, which
+                is waited for to release the device before opening it again.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.opener = opener
+        self.previous = previous
+        self.capture = None
+        self.warmup = warmup
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.frame = None
+        self.taken = None
+        self.free = []
+        self.active = True
+        self.running = threading.Event()
+        self.wake = threading.Event()
+        self.displaying = False
+        self.detector = detector
+        self.sampleInterval = sampleInterval
+        self.onPresence = onPresence
+        self.lastSample = 0.0
+        self.captured = 0
+        self.dropped = 0
+        if detector is not None:
+            self.running.set()
+
+    def run(self):
+        try:
+            if self.previous is not None:
+                # the old thread may still be blocked in read() with the device open
+                self.previous.join()
+                self.previous = None
+            if not self.active:
+                return
+            t0 = time.perf_counter()
+            self.capture = self.opener()
+            for _ in range(self.warmup):
+                if not self.active:
+                    break
+                self.capture.read()
+            if self.metrics:
+                self.metrics.observe("camera-open", time.perf_counter() - t0)
+            while self.active:
+                self.running.wait()
+                if not self.active:
+                    break
+                if not self.displaying:
+                    # only sensing motion, so read at the sampling rate
+                    delay = self.lastSample + self.sampleInterval - time.perf_counter()
+                    if delay > 0:
+                        self.wake.wait(delay)
+                        self.wake.clear()
+                        continue
+                t0 = time.perf_counter()
+                with self.lock:
+                    buffer = self.free.pop() if self.free else None
+                rval, frame = self.capture.read(buffer)
+                if not rval:
+                    if self.metrics:
+                        self.metrics.inc("camera-read-errors")
+                    time.sleep(0.1)
+                    continue
+                if self.metrics:
+                    self.metrics.observe("camera-read", time.perf_counter() - t0)
+                if self.detector is not None and t0 - self.lastSample >= self.sampleInterval:
+                    self.lastSample = t0
+                    self.sampleMotion(frame)
+                if not self.displaying:
+                    with self.lock:
+                        self.free.append(frame)
+                    continue
+                with self.lock:
+                    dropped = self.frame is not None
+                    if dropped:
+                        self.free.append(self.frame)
+                    self.frame = frame
+                    self.captured += 1
+                    self.dropped += dropped
+                if dropped and self.metrics:
+                    self.metrics.inc("camera-frames-dropped")
+        finally:
+            if self.capture is not None:
+                self.capture.release()
+
+    def sampleMotion(self, frame):
+        """
+        Run motion detection on a frame and report changes of presence.
+        """
+        if not self.active:
+            # replaced by another thread sharing the detector
+            return
+        t0 = time.perf_counter()
+        changed = self.detector.sample(frame)
+        if self.metrics:
+            self.metrics.observe("motion-sample", time.perf_counter() - t0)
+        if changed:
+            if self.metrics:
+                self.metrics.inc("motion-arrivals" if self.detector.present else "motion-departures")
+            if self.onPresence:
+                self.onPresence(self.detector.present)
+
+    def takeFrame(self):
+        """
+        Take the newest frame without waiting. The frame stays valid until a
+        newer one is taken.
+
+        Returns: BGR numpy array, or None if no new frame arrived since the last call.
+        """
+        with self.lock:
+            frame, self.frame = self.frame, None
+            if frame is not None:
+                if self.taken is not None:
+                    self.free.append(self.taken)
+                self.taken = frame
+        return frame
+
+    def resume(self):
+        """
+        Start or continue capturing every frame for display.
+        """
+        self.displaying = True
+        self.running.set()
+        self.wake.set()
+
+    def pause(self):
+        """
+        Stop capturing for display after the current frame, and discard any
+        untaken frame. Motion sensing continues.
+        """
+        self.displaying = False
+        if self.detector is None:
+            self.running.clear()
+        with self.lock:
+            self.frame = None
+            self.free = []
+
+    def stop(self):
+        """
+        Stop capturing for good; the device is released by the thread.
+        """
+        self.active = False
+        self.running.set()
+        self.wake.set()
@@ -1,40 +1,145 @@
+import time
+
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import QVBoxLayout, QWidget
-from PyQt5.QtCore import QSize, Qt, QTimer
-from PyQt5.QtGui import QImage, QPainter, QColor, QFont
-
-import cv2
+from PyQt5.QtCore import QSize, Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QPainter, QColor, QFont
 
 from moframe.basewidget import BaseWidget
+from moframe.camerasource import CaptureThread, FrameConverter, MotionDetector, negotiateMode, openCapture
+from moframe.metrics import Metrics
 
 
 class CameraWidget(BaseWidget):
+    """
+    Shows the camera as a mirror. Frames are captured on a CaptureThread and
+    picked up on a timer without blocking, so a slow sensor never delays
+    input handling.
+
+    The device is opened in the background once the widget is started and
+    shown, in a mode matching the widget size and camera-delay, renegotiated
+    when the size changes substantially, and released once the widget has been
+    paused for camera-idle-release seconds.
+
+    With motion-sense enabled, the capture keeps sampling for motion while the
+    widget is hidden or paused, in a small low rate mode once idle, and
+    presenceChanged tells whether anybody is around.
+    """
     image = None
     paused = False
+    presenceChanged = pyqtSignal(bool)
+    sensingSize = (320, 240)
+    # relative change of the widget size that makes the capture mode renegotiated
+    resizeTolerance = 0.2
 
     def __init__(self, parent, cfg=None):
         QWidget.__init__(self, parent)
         self.config = cfg or {}
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update)
-        self.vc = cv2.VideoCapture(cfg.get("camera-index", 0))
-        self.vc.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)
-        self.vc.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        self.vc.set(cv2.CAP_PROP_FRAME_HEIGHT, 800)
+        self.metrics = Metrics("camera")
+        self.converter = FrameConverter(self.config.get("invert", ""))
+        self.releasetimer = QTimer(self)
+        self.releasetimer.setSingleShot(True)
+        self.releasetimer.timeout.connect(self.idle)
+        self.negotiatetimer = QTimer(self)
+        self.negotiatetimer.setSingleShot(True)
+        self.negotiatetimer.timeout.connect(self.negotiate)
+        self.capture = None
+        self.captureMode = None
+        self.detector = None
+        if self.config.get("motion-sense", False):
+            self.detector = MotionDetector(
+                threshold=self.config.get("motion-threshold", 0.02),
+                timeout=self.config.get("motion-timeout", 300.0),
+            )
+            self.openCapture(self.getCaptureMode(sensing=True))
+
+    def getCaptureMode(self, sensing=False):
+        """
+        Args:
+            sensing: If True, the mode for motion sensing only, otherwise the
+                mode for showing the camera in this widget.
+
+        Returns: Capture mode as chosen by negotiateMode.
+        """
+        if sensing:
+            return negotiateMode(self.config, self.sensingSize, 1.0 / self.config.get("motion-interval", 0.5))
+        size = (max(1, self.width()), max(1, self.height()))
+        return negotiateMode(self.config, size, 1.0 / self.config.get("camera-delay", 0.1))
+
+    def matchesMode(self, mode):
+        """
+        Returns: True iff the device is open in a mode close enough to mode.
+        """
+        if self.capture is None or not self.capture.is_alive() or self.captureMode is None:
+            return False
+        (width, height, fps, fourcc), (ow, oh, ofps, ofourcc) = mode, self.captureMode
+        return (
+            (fps, fourcc) == (ofps, ofourcc)
+            and abs(width - ow) <= self.resizeTolerance * ow
+            and abs(height - oh) <= self.resizeTolerance * oh
+        )
+
+    def openCapture(self, mode):
+        """
+        Open the device in the given mode on a new capture thread, unless it
+        is open in that mode already. The new thread waits for the old one to
+        release the device.
+        """
+        if self.matchesMode(mode):
+            return
+        previous = self.closeCapture()
+        self.captureMode = mode
+        self.capture = CaptureThread(
+            lambda: openCapture(self.config, mode), self.metrics, detector=self.detector,
+            sampleInterval=self.config.get("motion-interval", 0.5), onPresence=self.presenceChanged.emit,
+            warmup=self.config.get("camera-warmup-frames", 5), previous=previous,
+        )
+        self.capture.start()
+
+    def closeCapture(self):
+        """
+        Stop the capture thread, which releases the device.
+
+        Returns: The stopped thread, or None.
+        """
+        previous = self.capture
+        if previous is not None:
+            previous.stop()
+            self.capture = None
+        return previous
+
+    def negotiate(self):
+        """
+        Open the device for showing it in this widget at its current size,
+        once the widget is started and shown.
+        """
+        if self.paused or not self.isVisible():
+            return
+        self.openCapture(self.getCaptureMode())
+        self.capture.resume()
+
+    def idle(self):
+        """
+        Release the device after the widget has been paused for a while, or
+        fall back to the motion sensing mode.
+        """
+        if self.detector is not None:
+            self.openCapture(self.getCaptureMode(sensing=True))
+        else:
+            self.closeCapture()
 
     def update(self):
         """
         Update display as needed.
         """
-        invert = self.config.get("invert", "")
-        self.timer.stop()
-        rval, frame = self.vc.read()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        if "x" in invert:
-            frame = cv2.flip(frame, 1)
-        if "y" in invert:
-            frame = cv2.flip(frame, 0)
-        image = QImage(frame, frame.shape[1], frame.shape[0], QImage.Format_RGB888)
+        frame = self.capture.takeFrame() if self.capture else None
+        if frame is None:
+            return
+        t0 = time.perf_counter()
+        image = self.converter.convert(frame)
+        self.metrics.observe("camera-convert", time.perf_counter() - t0)
         self.setImage(image)
 
     def setImage(self, img):
@@ -60,16 +165,26 @@ class CameraWidget(BaseWidget):
             w, h = self.width(), self.height()
             img = self.image # self.image.scaled(w, h, aspectRatioMode=Qt.KeepAspectRatioByExpanding)
             imw, imh = img.width(), img.height()
-            ix = max(0, (imw - w) / 2)
-            iy = max(0, (imh - h) / 2)
+            ix = max(0, (imw - w) // 2)
+            iy = max(0, (imh - h) // 2)
             qp.drawImage(0, 0, img, ix, iy)
         else:
             qp.setPen(QColor(168, 34, 3))
             qp.setFont(QFont('Decorative', 10))
             qp.drawText(event.rect(), Qt.AlignCenter, "nothing to show...")
         qp.end()
-        if not self.paused:
-            self.timer.start(self.config.get("camera-delay", 0.1) * 1000)
+
+    def showEvent(self, event):
+        """
+        Negotiate the capture mode once shown, when the size is known.
+        """
+        self.negotiatetimer.start(100)
+
+    def resizeEvent(self, event):
+        """
+        Renegotiate the capture mode once resizing settles.
+        """
+        self.negotiatetimer.start(100)
 
     def buttonName(self):
         """
@@ -82,20 +197,29 @@ class CameraWidget(BaseWidget):
         Start or resume widget.
         """
         self.paused = False
-        self.timer.start(1)
+        self.releasetimer.stop()
+        # before the window is shown the widget does not have its final size yet
+        self.negotiate()
+        self.timer.start(int(self.config.get("camera-delay", 0.1) * 1000))
 
     def pause(self):
         """
         Temporarily stop the widget from updating.
         """
         self.timer.stop()
+        if self.capture is not None:
+            self.capture.pause()
         self.paused = True
+        self.releasetimer.start(int(self.config.get("camera-idle-release", 30.0) * 1000))
 
     def stop(self):
         """
         Stop the widget terminally.
         """
         self.pause()
+        self.releasetimer.stop()
+        self.negotiatetimer.stop()
+        self.closeCapture()
 
     def keyPressEvent(self, event):
         """
@@ -106,3 +230,13 @@ class CameraWidget(BaseWidget):
         """
         pass
 
+    def getStatus(self):
+        """
+        Return status information as a dictionary.
+        """
+        status = {
+            "frames-captured": str(self.capture.captured if self.capture else 0),
+            "capture-mode": "{}x{} at {:.0f} fps {}".format(*self.captureMode) if self.capture else "closed",
+        }
+        status.update(self.metrics.getStatus())
+        return status
@@ -0,0 +1,152 @@
+import os.path
+from array import array
+
+
+class Catalogue(object):
+    """
+    Compact in-memory table of library files, identified by their id in the
+    library index. Each directory name is stored once, and files refer to it by
+    a directory id kept in an array. Capture times and EXIF orientations are
+    kept in arrays as well, 0 where unknown.
+    """
+    def __init__(self):
+        self.roots = {}
+        self.dirs = array("I")
+        self.taken = array("I")
+        self.orientations = array("B")
+        self.names = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, fileid):
+        return fileid is not None and 0 <= fileid < len(self.names) and self.names[fileid] is not None
+
+    def reserve(self, fileid):
+        """
+        Grow the tables to hold file ids up to and including fileid.
+        """
+        missing = fileid + 1 - len(self.names)
+        if missing > 0:
+            self.names.extend([None] * missing)
+            self.dirs.extend(array("I", bytes(4 * missing)))
+            self.taken.extend(array("I", bytes(4 * missing)))
+            self.orientations.extend(array("B", bytes(missing)))
+
+    def addDir(self, dirid, root):
+        """
+        Register the name of a directory.
+        """
+        if dirid not in self.roots:
+            self.roots[dirid] = root
+
+    def add(self, fileid, dirid, name, taken=0, orientation=0):
+        """
+        Add a file in a registered directory.
+
+        Returns: True iff the file was not already present.
+        """
+        self.reserve(fileid)
+        added = self.names[fileid] is None
+        self.names[fileid] = name
+        self.dirs[fileid] = dirid
+        if added:
+            self.count += 1
+            self.setMetadata(fileid, taken, orientation)
+        return added
+
+    def setMetadata(self, fileid, taken, orientation):
+        """
+        Record capture time in seconds since the epoch and EXIF orientation of
+        a file, where 0 means unknown.
+        """
+        if fileid in self:
+            self.taken[fileid] = max(0, min(taken or 0, 0xFFFFFFFF))
+            self.orientations[fileid] = orientation or 0
+
+    def remove(self, fileid):
+        """
+        Remove a file.
+
+        Returns: True iff the file was present.
+        """
+        if fileid not in self:
+            return False
+        self.names[fileid] = None
+        self.taken[fileid] = 0
+        self.orientations[fileid] = 0
+        self.count -= 1
+        return True
+
+    def key(self, fileid):
+        """
+        Returns: (root, file) of a file, or ("", "") if unknown.
+        """
+        if fileid not in self:
+            return ("", "")
+        return (self.roots.get(self.dirs[fileid], ""), self.names[fileid])
+
+    def path(self, fileid):
+        """
+        Returns: Full filename of a file.
+        """
+        return os.path.join(*self.key(fileid))
+
+
+class HistoryRing(object):
+    """
+    Ring buffer of file ids, oldest first. Appending to a full ring drops the
+    oldest entry. Indexing works like for a list, negative indices count from
+    the most recent.
+    """
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.data = array("I")
+        self.start = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, ii):
+        size = len(self.data)
+        if ii < 0:
+            ii += size
+        if not 0 <= ii < size:
+            raise IndexError("history index out of range")
+        return self.data[(self.start + ii) % size]
+
+    def __iter__(self):
+        for ii in range(len(self.data)):
+            yield self[ii]
+
+    def append(self, fileid):
+        """
+        Add a file id as the most recent entry.
+        """
+        if len(self.data) < self.capacity:
+            self.data.append(fileid)
+        else:
+            self.data[self.start] = fileid
+            self.start = (self.start + 1) % self.capacity
+
+    def tobytes(self):
+        """
+        Returns: Entries oldest first, as machine-order bytes.
+        """
+        return (self.data[self.start:] + self.data[:self.start]).tobytes()
+
+    def frombytes(self, data, keep=None):
+        """
+        Replace entries by those from tobytes.
+
+        Args:
+            data: Bytes as returned by tobytes.
+            keep: Optional predicate, entries for which it is False are dropped.
+        """
+        entries = array("I")
+        entries.frombytes(data[:len(data) - len(data) % entries.itemsize])
+        if keep is not None:
+            entries = array("I", [fileid for fileid in entries if keep(fileid)])
+        self.data = entries[-self.capacity:]
+        self.start = 0
@@ -0,0 +1,335 @@
+import calendar
+import datetime
+import fnmatch
+import os.path
+import random
+import time
+from array import array
+
+from moframe.shufflebag import ShuffleBag
+
+
+DAY = 86400
+
+
+def dayOfYear(seconds):
+    """
+    Returns: Day of the year 1-366 of a time in seconds since the epoch, counted
+    as in a leap year so that a date maps to the same day in every year.
+    """
+    tm = time.gmtime(seconds)
+    return datetime.date(2000, tm.tm_mon, tm.tm_mday).timetuple().tm_yday
+
+
+def localNow():
+    """
+    Returns: Current local time in seconds since the epoch, taking it as UTC
+    like the capture times of photos.
+    """
+    return calendar.timegm(time.localtime())
+
+
+class AliasTable(object):
+    """
+    Walker's alias method: after O(n) setup, samples an index with probability
+    proportional to its weight in O(1).
+    """
+    def __init__(self, weights):
+        """
+        Args:
+            weights: Non-negative weights, not all zero.
+        """
+        n = len(weights)
+        total = float(sum(weights))
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        scaled = [w * n / total for w in weights]
+        small = [ii for ii, p in enumerate(scaled) if p < 1.0]
+        large = [ii for ii, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self):
+        """
+        Returns: Random index.
+        """
+        ii = random.randrange(len(self.prob))
+        return ii if random.random() < self.prob[ii] else self.alias[ii]
+
+
+class Category(object):
+    """
+    Named selection of the library defined by rules on directory and capture
+    date, with a shuffle bag of its files.
+    """
+    def __init__(self, name, weight=1.0, dirs=None, takenWithinDays=None, onThisDay=None):
+        """
+        Args:
+            name: Name of the category, "" for all files.
+            weight: Relative share of images drawn from this category.
+            dirs: Optional list of fnmatch patterns, one of which the directory
+                relative to the library must match.
+            takenWithinDays: Optional number of days before now the photo must
+                have been taken within.
+            onThisDay: Optional number of days around today's date in an
+                earlier year the photo must have been taken within.
+        """
+        self.name = name
+        self.weight = float(weight)
+        self.dirs = dirs
+        self.takenWithinDays = takenWithinDays
+        self.onThisDay = onThisDay
+        self.bag = ShuffleBag()
+
+    @property
+    def dateBased(self):
+        return self.takenWithinDays is not None or self.onThisDay is not None
+
+    def matchesDir(self, relroot):
+        """
+        Returns: True iff files in the directory can belong to the category.
+        """
+        return not self.dirs or any(fnmatch.fnmatch(relroot, pattern) for pattern in self.dirs)
+
+    def matchesDate(self, taken, now):
+        """
+        Args:
+            taken: Capture time in seconds since the epoch, 0 if unknown.
+            now: Current time in the same terms.
+
+        Returns: True iff a photo taken at that time belongs to the category.
+        """
+        if not self.dateBased:
+            return True
+        if not taken:
+            return False
+        if self.takenWithinDays is not None and not now - self.takenWithinDays * DAY <= taken <= now:
+            return False
+        if self.onThisDay is not None:
+            distance = abs(dayOfYear(taken) - dayOfYear(now))
+            if min(distance, 366 - distance) > self.onThisDay or taken > now - 300 * DAY:
+                return False
+        return True
+
+
+class CategoryIndex(object):
+    """
+    Categories of the library, each with its own shuffle bag, and an alias
+    table over the non-empty ones to choose the category of each draw in O(1).
+
+    Adding or removing a file touches only the bags of its categories. The alias
+    table is rebuilt, in time proportional to the number of categories, only
+    when a category becomes empty or non-empty. Date-based categories are
+    recomputed once a day. The category "" holds all files; it is drawn from
+    with weight 1 if no categories are configured, and otherwise only if all
+    weighted categories are empty, unless configured with a weight.
+
+    Not thread-safe, callers must serialize access.
+    """
+    def __init__(self, rules=None, basepath="."):
+        """
+        Args:
+            rules: List of dictionaries with "name", and optionally "weight",
+                "dirs", "taken-within-days" and "on-this-day".
+            basepath: Root directory of the library.
+        """
+        self.basepath = basepath
+        self.categories = {}
+        for rule in rules or ():
+            self.categories[rule.get("name", "")] = Category(
+                rule.get("name", ""),
+                weight=rule.get("weight", 1.0),
+                dirs=rule.get("dirs"),
+                takenWithinDays=rule.get("taken-within-days"),
+                onThisDay=rule.get("on-this-day"),
+            )
+        if "" not in self.categories:
+            self.categories[""] = Category("", weight=0.0 if rules else 1.0)
+        self.dirCategories = {}
+        self.table = None
+        self.tableCategories = []
+        self.now = localNow()
+        self.day = self.now // DAY
+
+    def __getitem__(self, name):
+        return self.categories[name].bag
+
+    def __contains__(self, name):
+        return name in self.categories
+
+    def getCategories(self, dirid, root):
+        """
+        Returns: Categories that files in a directory can belong to, cached by directory.
+        """
+        cats = self.dirCategories.get(dirid)
+        if cats is None:
+            relroot = os.path.relpath(root, self.basepath)
+            cats = self.dirCategories[dirid] = [cat for cat in self.categories.values() if cat.matchesDir(relroot)]
+        return cats
+
+    def addTo(self, cat, fileid, drawn=False):
+        """
+        Add a file to one category.
+        """
+        if not cat.bag:
+            self.table = None
+        cat.bag.add(fileid, drawn=drawn)
+
+    def discardFrom(self, cat, fileid):
+        """
+        Remove a file from one category.
+        """
+        cat.bag.discard(fileid)
+        if not cat.bag:
+            self.table = None
+
+    def add(self, fileid, dirid, root, taken=0, drawn=False):
+        """
+        Add a file to all categories it belongs to.
+
+        Args:
+            fileid: Catalogue id of the file.
+            dirid: Catalogue id of its directory.
+            root: Full path of its directory.
+            taken: Capture time in seconds since the epoch, 0 if unknown.
+            drawn: If True, the file counts as already drawn in the current cycle.
+        """
+        for cat in self.getCategories(dirid, root):
+            if cat.matchesDate(taken, self.now):
+                self.addTo(cat, fileid, drawn=drawn)
+
+    def update(self, fileid, dirid, root, taken):
+        """
+        Move a file into or out of date-based categories after its capture time
+        became known.
+        """
+        for cat in self.getCategories(dirid, root):
+            if cat.dateBased:
+                if cat.matchesDate(taken, self.now):
+                    self.addTo(cat, fileid)
+                else:
+                    self.discardFrom(cat, fileid)
+
+    def discard(self, fileid):
+        """
+        Remove a file from all categories.
+        """
+        for cat in self.categories.values():
+            if fileid in cat.bag:
+                self.discardFrom(cat, fileid)
+
+    def markDrawn(self, fileid):
+        """
+        Count a file as drawn in every category, so that it does not come up
+        again soon through another one.
+        """
+        everything = self.categories[""].bag
+        if everything and not everything.remaining():
+            # not necessarily drawn from directly, but its cycle is the one persisted
+            everything.restart()
+        for cat in self.categories.values():
+            cat.bag.markDrawn(fileid)
+
+    def draw(self, fallback=False):
+        """
+        Choose a category by weight, then draw a file from it.
+
+        Args:
+            fallback: If True, draw from all files instead, for when the
+                weighted categories only hold files that are already queued.
+
+        Returns: Catalogue id of a file, or None if there are none.
+        """
+        if fallback:
+            fileid = self.categories[""].bag.draw()
+            if fileid is not None:
+                self.markDrawn(fileid)
+            return fileid
+        if self.table is None:
+            self.tableCategories = [cat for cat in self.categories.values() if cat.bag and cat.weight > 0]
+            if self.tableCategories:
+                self.table = AliasTable([cat.weight for cat in self.tableCategories])
+            else:
+                self.tableCategories = [self.categories[""]]
+                self.table = AliasTable([1.0])
+        fileid = self.tableCategories[self.table.sample()].bag.draw()
+        if fileid is not None:
+            self.markDrawn(fileid)
+        return fileid
+
+    def needsRefresh(self):
+        """
+        Returns: True iff the day changed since date-based categories were computed.
+        """
+        return localNow() // DAY != self.day and any(cat.dateBased for cat in self.categories.values())
+
+    def collectDateBased(self, catalogue, now):
+        """
+        Compute members of date-based categories for the given time, without
+        modifying anything. Only reads a copy of the catalogue's arrays, so it
+        can be called without holding the lock that protects the catalogue.
+
+        Args:
+            catalogue: (taken, dirs, roots) copied from a Catalogue.
+            now: Current local time in seconds since the epoch.
+
+        Returns: Dictionary of category name to list of file ids.
+        """
+        taken, dirs, roots = catalogue
+        members = {}
+        for cat in self.categories.values():
+            if not cat.dateBased:
+                continue
+            relroots = {}
+            found = members[cat.name] = []
+            for fileid, seconds in enumerate(taken):
+                if seconds and cat.matchesDate(seconds, now):
+                    dirid = dirs[fileid]
+                    if dirid not in relroots:
+                        root = roots.get(dirid)
+                        relroots[dirid] = root is not None and cat.matchesDir(os.path.relpath(root, self.basepath))
+                    if relroots[dirid]:
+                        found.append(fileid)
+        return members
+
+    def replaceDateBased(self, members, now, exists):
+        """
+        Replace the contents of date-based categories by those computed by
+        collectDateBased.
+
+        Args:
+            members: As returned by collectDateBased.
+            now: Time they were computed for.
+            exists: Predicate telling whether a file id is still in the catalogue.
+        """
+        self.now = now
+        self.day = now // DAY
+        for name, fileids in members.items():
+            cat = self.categories[name]
+            cat.bag = ShuffleBag(fileid for fileid in fileids if exists(fileid))
+        self.table = None
+
+    @staticmethod
+    def snapshot(catalogue):
+        """
+        Returns: Copy of the parts of a Catalogue needed by collectDateBased.
+        """
+        return array("I", catalogue.taken), array("I", catalogue.dirs), dict(catalogue.roots)
+
+    def getStatus(self):
+        """
+        Returns: Dictionary describing the size and weight of each category.
+        """
+        return {
+            "categories": ", ".join(
+                "{} {} x{:g}".format(cat.name or "all", len(cat.bag), cat.weight)
+                for cat in self.categories.values()
+            ),
+        }
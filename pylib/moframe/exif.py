@@ -0,0 +1,157 @@
+import calendar
+import struct
+import time
+
+
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_DATETIME_DIGITIZED = 0x9004
+# JPEG start-of-frame markers, which carry the image dimensions
+SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+# EXIF orientations whose stored image is transposed relative to the displayed one
+TRANSPOSED = (5, 6, 7, 8)
+
+
+def parseDate(value):
+    """
+    Args:
+        value: EXIF date string "YYYY:MM:DD HH:MM:SS".
+
+    Returns: Seconds since the epoch, taking the local time of capture as UTC,
+    or None if missing or invalid.
+    """
+    try:
+        return calendar.timegm(time.strptime(value.strip("\0 ")[:19], "%Y:%m:%d %H:%M:%S"))
+    except (ValueError, OverflowError):
+        return None
+
+
+def parseTiff(data):
+    """
+    Read the tags we need from an EXIF TIFF structure.
+
+    Args:
+        data: Bytes starting with the TIFF header.
+
+    Returns: Dictionary with "taken" and "orientation" where found.
+    """
+    order = {b"II": "<", b"MM": ">"}.get(data[:2])
+    if order is None:
+        return {}
+    tags = {}
+
+    def readIfd(offset, wanted):
+        count, = struct.unpack_from(order + "H", data, offset)
+        for ii in range(count):
+            tag, kind, n, value = struct.unpack_from(order + "HHI4s", data, offset + 2 + 12 * ii)
+            if tag not in wanted:
+                continue
+            if kind == 3:
+                tags[tag] = struct.unpack_from(order + "H", value)[0]
+            elif kind == 4:
+                tags[tag] = struct.unpack_from(order + "I", value)[0]
+            elif kind == 2:
+                start = struct.unpack_from(order + "I", value)[0] if n > 4 else None
+                tags[tag] = (value[:n] if start is None else data[start:start + n]).decode("ascii", "replace")
+
+    readIfd(struct.unpack_from(order + "I", data, 4)[0], (TAG_ORIENTATION, TAG_DATETIME, TAG_EXIF_IFD))
+    if TAG_EXIF_IFD in tags:
+        readIfd(tags[TAG_EXIF_IFD], (TAG_DATETIME_ORIGINAL, TAG_DATETIME_DIGITIZED))
+    result = {}
+    for tag in (TAG_DATETIME_ORIGINAL, TAG_DATETIME_DIGITIZED, TAG_DATETIME):
+        if isinstance(tags.get(tag), str) and parseDate(tags[tag]) is not None:
+            result["taken"] = parseDate(tags[tag])
+            break
+    if 1 <= tags.get(TAG_ORIENTATION, 0) <= 8:
+        result["orientation"] = tags[TAG_ORIENTATION]
+    return result
+
+
+def readJpeg(fh):
+    """
+    Walk the JPEG segments up to the start of the image data, reading only the
+    EXIF segment and the frame header.
+    """
+    result = {}
+    fh.seek(2)
+    while True:
+        header = fh.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            break
+        marker, length = header[1], struct.unpack(">H", header[2:])[0]
+        if marker == 0xDA or length < 2:
+            break
+        if marker == 0xE1 and "orientation" not in result and "taken" not in result:
+            segment = fh.read(length - 2)
+            if segment[:6] == b"Exif\0\0":
+                result.update(parseTiff(segment[6:]))
+            continue
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack(">xHH", fh.read(5))
+            result["width"], result["height"] = width, height
+            break
+        fh.seek(length - 2, 1)
+    return result
+
+
+def readPng(fh):
+    """
+    Walk the PNG chunks up to the image data, reading the header and any EXIF chunk.
+    """
+    result = {}
+    fh.seek(8)
+    while True:
+        header = fh.read(8)
+        if len(header) < 8:
+            break
+        length, kind = struct.unpack(">I4s", header)
+        if kind == b"IHDR":
+            result["width"], result["height"] = struct.unpack(">II", fh.read(8))
+            fh.seek(length - 8 + 4, 1)
+        elif kind == b"eXIf":
+            result.update(parseTiff(fh.read(length)))
+            fh.seek(4, 1)
+        elif kind in (b"IDAT", b"IEND"):
+            break
+        else:
+            fh.seek(length + 4, 1)
+    return result
+
+
+def readMetadata(path):
+    """
+    Extract capture date, orientation and dimensions from the file headers,
+    without decoding any pixels.
+
+    Args:
+        path: Filename of an image.
+
+    Returns: Dictionary with any of "taken" (seconds since the epoch),
+    "orientation" (EXIF orientation 1-8), "width" and "height" that could be
+    determined. Empty if the file cannot be read or parsed.
+    """
+    try:
+        with open(path, "rb") as fh:
+            magic = fh.read(26)
+            if magic[:2] == b"\xff\xd8":
+                return readJpeg(fh)
+            if magic[:8] == b"\x89PNG\r\n\x1a\n":
+                return readPng(fh)
+            if magic[:4] in (b"GIF8",):
+                width, height = struct.unpack_from("<HH", magic, 6)
+                return {"width": width, "height": height}
+            if magic[:2] == b"BM":
+                width, height = struct.unpack_from("<ii", magic, 18)
+                return {"width": width, "height": abs(height)}
+    except (OSError, struct.error, ValueError, IndexError):
+        pass
+    return {}
+
+
+def readOrientation(path):
+    """
+    Returns: EXIF orientation of an image file, 1 (upright) if unknown.
+    """
+    return readMetadata(path).get("orientation", 1)
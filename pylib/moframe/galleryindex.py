@@ -0,0 +1,391 @@
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY,
+    root TEXT NOT NULL UNIQUE,
+    mtime REAL NOT NULL DEFAULT 0,
+    subdirs TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dir INTEGER NOT NULL REFERENCES dirs(id),
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    contents TEXT NOT NULL,
+    UNIQUE (dir, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+COLUMNS = {
+    "files": [
+        ("drawn", "INTEGER NOT NULL DEFAULT -1"),
+        # header metadata, valid iff parsed is 1
+        ("parsed", "INTEGER NOT NULL DEFAULT 0"),
+        ("taken", "INTEGER"),
+        ("orientation", "INTEGER NOT NULL DEFAULT 0"),
+        ("width", "INTEGER"),
+        ("height", "INTEGER"),
+        # perceptual hash as signed 64 bits, 0 if it could not be computed
+        ("phash", "INTEGER"),
+    ],
+}
+
+
+def isIgnoredDir(root):
+    """
+    Directories whose name start with an underscore do not contribute files.
+
+    Args:
+        root: Full path of directory.
+
+    Returns: True iff files directly inside root should be ignored.
+    """
+    return os.path.split(root)[-1].startswith("_")
+
+
+class GalleryIndex(object):
+    """
+    Persistent catalogue of a photo library, stored as an SQLite database.
+
+    Each directory is stored with its mtime and list of sub-directories, so that
+    a later scan only needs to list directories that have actually changed.
+    """
+    commitInterval = 2.0
+
+    def __init__(self, path, classify):
+        """
+        Args:
+            path: Filename of the database, or ":memory:".
+            classify: Function mapping a filename to a media type, or None if
+                the file should not be indexed.
+        """
+        self.path = path
+        self.classify = classify
+        self.lock = threading.RLock()
+        self.lastCommit = time.time()
+        self.db = self.connect(path)
+
+    @classmethod
+    def connect(cls, path):
+        """
+        Open database, falling back to an in-memory one if the file is unusable.
+        """
+        try:
+            if path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            cls.migrate(db)
+        except (OSError, sqlite3.Error) as e:
+            print("Error: could not open index:", path, e)
+            db = sqlite3.connect(":memory:", check_same_thread=False)
+            cls.migrate(db)
+        return db
+
+    @classmethod
+    def migrate(cls, db):
+        """
+        Create tables, and add columns missing from an index written by an older version.
+        File ids of an older index are kept, but no longer reused after deletions,
+        which would let the history point at another file.
+        """
+        db.executescript(SCHEMA)
+        for table, columns in COLUMNS.items():
+            existing = set(row[1] for row in db.execute("PRAGMA table_info({})".format(table)))
+            for name, decl in columns:
+                if name not in existing:
+                    db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, name, decl))
+        db.commit()
+        sql = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone()[0]
+        if "AUTOINCREMENT" not in sql.upper():
+            # the table has to be rebuilt, with its columns in the same order
+            db.execute("BEGIN")
+            db.execute("ALTER TABLE files RENAME TO files_old")
+            db.execute(sql.replace("INTEGER PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT", 1))
+            db.execute("INSERT INTO files SELECT * FROM files_old")
+            db.execute("DROP TABLE files_old")
+            db.commit()
+
+    def getMeta(self, key, default=None):
+        """
+        Returns: Stored value for key, or default.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def setMeta(self, key, value):
+        """
+        Store a value for key.
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+        self.commit()
+
+    def load(self):
+        """
+        Returns:
+            (dirs, files) where dirs is a list of (dir id, root) and files a list
+            of (file id, dir id, file, drawn, taken, orientation) ordered by id,
+            drawn is True iff the file has been shown in the current shuffle
+            cycle, and taken and orientation are 0 if unknown.
+        """
+        cycle = self.getMeta("cycle", 0)
+        with self.lock:
+            dirs = self.db.execute("SELECT id, root FROM dirs").fetchall()
+            files = self.db.execute(
+                "SELECT id, dir, name, drawn = ?, COALESCE(taken, 0), orientation FROM files ORDER BY id",
+                (cycle,)).fetchall()
+        return dirs, files
+
+    def listUnparsed(self, limit):
+        """
+        Returns: List of up to limit (file id, root, file) whose header metadata
+        has not been extracted yet.
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT files.id, dirs.root, files.name FROM files JOIN dirs ON files.dir = dirs.id "
+                "WHERE files.parsed = 0 AND files.contents = 'image' LIMIT ?", (limit,)).fetchall()
+
+    def storeMetadata(self, rows):
+        """
+        Store extracted header metadata, marking the files as parsed.
+
+        Args:
+            rows: List of (file id, metadata) where metadata is a dictionary as
+                returned by exif.readMetadata.
+        """
+        with self.lock:
+            self.db.executemany(
+                "UPDATE files SET parsed = 1, taken = ?, orientation = ?, width = ?, height = ? WHERE id = ?",
+                [
+                    (meta.get("taken"), meta.get("orientation", 0), meta.get("width"), meta.get("height"), fileid)
+                    for fileid, meta in rows
+                ],
+            )
+        self.commit()
+
+    def listUnhashed(self, limit):
+        """
+        Returns: List of up to limit (file id, dir id, root, file) of images
+        without a perceptual hash.
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT files.id, files.dir, dirs.root, files.name FROM files JOIN dirs ON files.dir = dirs.id "
+                "WHERE files.phash IS NULL AND files.contents = 'image' LIMIT ?", (limit,)).fetchall()
+
+    def clearHashes(self):
+        """
+        Forget all perceptual hashes, so that they are computed again.
+        """
+        with self.lock:
+            self.db.execute("UPDATE files SET phash = NULL")
+        self.commit(force=True)
+
+    def storeHashes(self, rows):
+        """
+        Store perceptual hashes.
+
+        Args:
+            rows: List of (file id, signed 64-bit hash).
+        """
+        with self.lock:
+            self.db.executemany("UPDATE files SET phash = ? WHERE id = ?", [(h, fileid) for fileid, h in rows])
+        self.commit()
+
+    def listHashes(self, dirid=None):
+        """
+        Args:
+            dirid: Optional directory id to restrict the result to.
+
+        Returns: List of (dir id, file id, signed 64-bit hash) of all hashed
+        images, ordered by directory.
+        """
+        query = "SELECT dir, id, phash FROM files WHERE phash IS NOT NULL AND phash != 0"
+        with self.lock:
+            if dirid is None:
+                return self.db.execute(query + " ORDER BY dir").fetchall()
+            return self.db.execute(query + " AND dir = ?", (dirid,)).fetchall()
+
+    def markDrawn(self, rows):
+        """
+        Record that files have been shown in the given shuffle cycles.
+
+        Args:
+            rows: List of (shuffle cycle number, file id).
+        """
+        with self.lock:
+            self.db.executemany("UPDATE files SET drawn = ? WHERE id = ?", rows)
+        self.commit()
+
+    def commit(self, force=False):
+        """
+        Commit pending changes, at most every commitInterval seconds unless forced.
+        """
+        now = time.time()
+        if force or now - self.lastCommit > self.commitInterval:
+            with self.lock:
+                self.db.commit()
+            self.lastCommit = now
+
+    def close(self):
+        """
+        Commit and close the database.
+        """
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def listDirs(self, basepath):
+        """
+        Args:
+            basepath: Directory to list.
+
+        Returns: List of indexed directories at or below basepath.
+        """
+        prefix = os.path.join(basepath, "")
+        with self.lock:
+            return [
+                root for root, in self.db.execute("SELECT root FROM dirs")
+                if root == basepath or root.startswith(prefix)
+            ]
+
+    def scan(self, basepath, forced=()):
+        """
+        Reconcile index with the file system. Directories whose mtime is unchanged
+        are not listed, only their known sub-directories are visited.
+
+        Args:
+            basepath: Root directory of the library, or a directory within it.
+            forced: Directories to list even if their mtime is unchanged, such as
+                ones with files that were rewritten in place.
+
+        Yields:
+            ("add" | "remove" | "change", (file id, dir id, root, file)) for each
+            change to the catalogue.
+        """
+        prefix = os.path.join(basepath, "")
+        with self.lock:
+            known = {
+                root: (mtime, subdirs)
+                for root, mtime, subdirs in self.db.execute("SELECT root, mtime, subdirs FROM dirs")
+                if root == basepath or root.startswith(prefix)
+            }
+        seen = set()
+        stack = [basepath]
+        while stack:
+            root = stack.pop()
+            if root in seen:
+                continue
+            seen.add(root)
+            try:
+                mtime = os.stat(root).st_mtime
+            except OSError:
+                continue
+            if root in known and known[root][0] == mtime and root not in forced:
+                subdirs = [name for name in known[root][1].split("\n") if name]
+            else:
+                subdirs = []
+                yield from self.scanDir(root, mtime, subdirs)
+            stack.extend(os.path.join(root, name) for name in reversed(sorted(subdirs)))
+        for root in set(known) - seen:
+            yield from self.removeDir(root)
+        self.commit(force=True)
+
+    def scanDir(self, root, mtime, subdirs=None):
+        """
+        List a single directory and update its entries in the index.
+
+        Args:
+            root: Full path of directory.
+            mtime: Modification time of directory.
+            subdirs: Optional list that is extended with names of sub-directories.
+
+        Yields:
+            ("add" | "remove" | "change", (file id, dir id, root, file)) for each
+            change to the catalogue; "change" for files whose size or mtime differ.
+        """
+        files = {}
+        dirnames = []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                dirnames.append(entry.name)
+                            continue
+                        contents = None if isIgnoredDir(root) else self.classify(entry.name)
+                        if contents:
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime, contents)
+                    except OSError:
+                        continue
+        except OSError as e:
+            print("Error: could not list directory:", root, e)
+            return
+        if subdirs is not None:
+            subdirs.extend(dirnames)
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO dirs (root, mtime, subdirs) VALUES (?, ?, ?) "
+                "ON CONFLICT (root) DO UPDATE SET mtime = excluded.mtime, subdirs = excluded.subdirs",
+                (root, mtime, "\n".join(dirnames)),
+            )
+            dirid = self.db.execute("SELECT id FROM dirs WHERE root = ?", (root,)).fetchone()[0]
+            old = {
+                name: (size, fmtime, fileid)
+                for fileid, name, size, fmtime in self.db.execute(
+                    "SELECT id, name, size, mtime FROM files WHERE dir = ?", (dirid,))
+            }
+            removed = [name for name in old if name not in files]
+            added = [name for name in files if name not in old]
+            changed = [name for name in files if name in old and old[name][:2] != files[name][:2]]
+            self.db.executemany(
+                "DELETE FROM files WHERE dir = ? AND name = ?", [(dirid, name) for name in removed])
+            self.db.executemany(
+                "INSERT INTO files (dir, name, size, mtime, contents) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (dir, name) DO UPDATE SET "
+                "size = excluded.size, mtime = excluded.mtime, contents = excluded.contents, parsed = 0, phash = NULL",
+                [(dirid, name) + files[name] for name in added + changed],
+            )
+            if added:
+                ids = dict(self.db.execute("SELECT name, id FROM files WHERE dir = ?", (dirid,)))
+        self.commit()
+        for name in removed:
+            yield "remove", (old[name][2], dirid, root, name)
+        for name in added:
+            yield "add", (ids[name], dirid, root, name)
+        for name in changed:
+            yield "change", (old[name][2], dirid, root, name)
+
+    def removeDir(self, root):
+        """
+        Remove a directory that no longer exists, and all its files, from the index.
+
+        Yields:
+            ("remove", (file id, dir id, root, file)) for each file that was indexed.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT id FROM dirs WHERE root = ?", (root,)).fetchone()
+            if row is None:
+                return
+            files = self.db.execute("SELECT id, name FROM files WHERE dir = ?", row).fetchall()
+            self.db.execute("DELETE FROM files WHERE dir = ?", row)
+            self.db.execute("DELETE FROM dirs WHERE id = ?", row)
+        self.commit()
+        for fileid, name in files:
+            yield "remove", (fileid, row[0], root, name)
@@ -1,37 +1,81 @@
 import threading
 import os
 import os.path
-from collections import defaultdict, deque
-import random
+from collections import deque, OrderedDict
+import hashlib
+import itertools
+import queue
 import time
 
-from PyQt5.QtGui import QImage, QMovie
-from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader, QTransform
+from PyQt5.QtCore import Qt, QObject, QRect, QSize, pyqtSignal
+
+from moframe import exif, perceptualhash, videoplayer
+from moframe.catalogue import Catalogue, HistoryRing
+from moframe.categories import CategoryIndex, localNow
+from moframe.galleryindex import GalleryIndex
+from moframe.imagecache import ImageCache
+from moframe.gallerywatcher import GalleryWatcher
+from moframe.metrics import Metrics, MetricsServer, TimedLock
+from moframe.rendercache import RenderCache
 
 
 EXT_IMAGE = ("jpg", "bmp", "png")
-EXT_ANIMATION = ("gif", "mov")
-EXT_ALL = EXT_IMAGE + EXT_ANIMATION
+EXT_ANIMATION = ("gif",)
+EXT_VIDEO = ("mov",)
+EXT_ALL = EXT_IMAGE + EXT_ANIMATION + EXT_VIDEO
+
+# decode request priorities, lower is more urgent
+PRIORITY_SHOW = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_PRELOAD = 2
+
+
+def mediaType(file):
+    """
+    Args:
+        file: Filename.
+
+    Returns: "image", "animation" or "video" depending on file extension, or
+    None if the file is not a known media file.
+    """
+    ext = file.rsplit(".", 1)[-1].lower()
+    if ext in EXT_IMAGE:
+        return "image"
+    if ext in EXT_ANIMATION:
+        return "animation"
+    if ext in EXT_VIDEO:
+        return "video"
+    return None
 
 
 class GalleryObject(object):
-    qdata = None
-    qpreview = None
-    contents = "unknown"
-    path = ("", "")
-    fullsize = (1280, 800)
-    previewsize = (200, 200)
-    error = None
-    validated = False
+    __slots__ = (
+        "qdata", "qpreview", "contents", "path", "fileid", "fullsize", "previewsize", "error",
+        "validated", "placeholder", "sourcesize", "reduced", "decodetime", "fittime", "orientation",
+        "framebudget", "duration", "fps",
+    )
 
     def __init__(self, path, **kwargs):
         root, file = path
+        self.qdata = None
+        self.qpreview = None
         self.path = path
-        ext = file.rsplit(".", 1)[-1].lower()
-        if ext in EXT_IMAGE:
-            self.contents = "image"
-        elif ext in EXT_ANIMATION:
-            self.contents = "animation"
+        self.fileid = None
+        self.contents = mediaType(file) or "unknown"
+        self.fullsize = (1280, 800)
+        self.previewsize = (200, 200)
+        self.error = None
+        self.validated = False
+        self.placeholder = False
+        self.sourcesize = None
+        self.reduced = False
+        self.decodetime = 0.0
+        self.fittime = 0.0
+        self.orientation = None
+        self.framebudget = 100e6
+        self.duration = 0.0
+        self.fps = 0.0
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -50,39 +94,162 @@ class GalleryObject(object):
         width, height = size
         img = img.scaled(width, height, aspectRatioMode=Qt.KeepAspectRatioByExpanding)
         imw, imh = img.width(), img.height()
-        ix = max(0, (imw - width) / 2)
-        iy = max(0, (imh - height) / 2)
+        ix = max(0, (imw - width) // 2)
+        iy = max(0, (imh - height) // 2)
         img = img.copy(ix, iy, width, height)
         return img
 
-    def getQImage(self):
+    @classmethod
+    def fitRect(cls, srcsize, size):
         """
-        Returns: QImage object containing the still image data.
+        Find the part of an image that remains after fitting it in size.
+
+        Args:
+            srcsize: Pixel width and height tuple of the image.
+            size: Desired pixel width and height tuple.
+
+        Returns: QRect of the centered crop, in image coordinates, with the
+        aspect ratio of size.
         """
-        if not self.contents == "image":
-            return None
-        if self.qdata is None and not self.error:
-            root, file = self.path
-            img = QImage(os.path.join(root, file))
+        (sw, sh), (width, height) = srcsize, size
+        scale = max(float(width) / sw, float(height) / sh)
+        cw, ch = min(sw, int(round(width / scale))), min(sh, int(round(height / scale)))
+        return QRect((sw - cw) // 2, (sh - ch) // 2, cw, ch)
+
+    @classmethod
+    def orient(cls, img, orientation):
+        """
+        Turn an image as stored into the upright image.
+
+        Args:
+            img: A QImage object.
+            orientation: EXIF orientation, 1-8.
+
+        Returns: Transformed QImage, or img itself if upright.
+        """
+        if orientation == 2:
+            return img.mirrored(True, False)
+        if orientation == 3:
+            return img.mirrored(True, True)
+        if orientation == 4:
+            return img.mirrored(False, True)
+        if orientation in (5, 6):
+            img = img.transformed(QTransform().rotate(90))
+            return img.mirrored(True, False) if orientation == 5 else img
+        if orientation in (7, 8):
+            img = img.transformed(QTransform().rotate(270))
+            return img.mirrored(True, False) if orientation == 7 else img
+        return img
+
+    def readQImage(self):
+        """
+        Decode the image file, letting the decoder crop and scale down to fullsize
+        while decoding if the format supports it (e.g. JPEG DCT scaling). Other
+        formats are decoded at full resolution and fitted afterwards. The EXIF
+        orientation is applied last, to the fitted image only.
+
+        Returns: QImage of size fullsize, or a null QImage on failure.
+        """
+        root, file = self.path
+        t0 = time.time()
+        if not self.orientation:
+            self.orientation = exif.readOrientation(os.path.join(root, file))
+        reader = QImageReader(os.path.join(root, file))
+        reader.setAutoTransform(False)
+        srcsize = reader.size()
+        width, height = self.fullsize
+        if self.orientation in exif.TRANSPOSED:
+            # fit the image as stored to the turned target size
+            width, height = height, width
+        self.reduced = False
+        if srcsize.isValid():
+            self.sourcesize = (srcsize.width(), srcsize.height())
+            if (
+                (srcsize.width() > width or srcsize.height() > height)
+                and reader.supportsOption(QImageIOHandler.ClipRect)
+                and reader.supportsOption(QImageIOHandler.ScaledSize)
+            ):
+                reader.setClipRect(self.fitRect(self.sourcesize, (width, height)))
+                reader.setScaledSize(QSize(width, height))
+                self.reduced = True
+        img = reader.read()
+        t1 = time.time()
+        self.decodetime = t1 - t0
+        if not img.isNull():
+            if (img.width(), img.height()) != (width, height):
+                img = self.fit(img, (width, height))
+            img = self.orient(img, self.orientation)
+        self.fittime = time.time() - t1
+        return img
+
+    def readFrames(self, cancelled=None):
+        """
+        Decode all frames of an animation, fitted to fullsize. If they would
+        take more than framebudget bytes, frames are kept at a proportionally
+        smaller size instead, to be scaled up when painted. The frames are not
+        kept by the object, only the poster is, so cached animations stay small.
+
+        Args:
+            cancelled: Optional function returning True once the frames are no
+                longer needed, checked before each frame.
+
+        Returns: List of (QImage, delay in milliseconds), empty on failure or
+        when cancelled.
+        """
+        root, file = self.path
+        t0 = time.time()
+        reader = QImageReader(os.path.join(root, file))
+        width, height = self.fullsize
+        count = reader.imageCount()
+        if count > 0 and count * width * height * 4 > self.framebudget:
+            scale = (self.framebudget / float(count * width * height * 4)) ** 0.5
+            width, height = max(1, int(width * scale)), max(1, int(height * scale))
+        frames = []
+        size = 0
+        while reader.canRead() and size < self.framebudget:
+            if cancelled is not None and cancelled():
+                return []
+            img = reader.read()
             if img.isNull():
-                self.error = "failed to load"
-                return None
-            self.qdata = self.fit(img, self.fullsize)
-        return self.qdata
+                break
+            if self.sourcesize is None:
+                self.sourcesize = (img.width(), img.height())
+            img = self.fit(img, (width, height)).convertToFormat(QImage.Format_RGB32)
+            frames.append((img, max(20, reader.nextImageDelay())))
+            size += img.sizeInBytes()
+        self.decodetime = time.time() - t0
+        return frames
+
+    def readPoster(self):
+        """
+        Decode the first frame of a video, fitted to fullsize, and find the
+        length of the video. The video itself is played by a VideoDecoder.
 
-    def getQMovie(self):
+        Returns: QImage of size fullsize, or a null QImage on failure.
         """
-        Returns: Qmovie object containing the animation.
+        root, file = self.path
+        t0 = time.time()
+        info = videoplayer.readVideoInfo(os.path.join(root, file), self.fullsize)
+        self.decodetime = time.time() - t0
+        if info is None:
+            if videoplayer.cv2 is None:
+                self.error = "video playback needs OpenCV"
+            return QImage()
+        poster, self.sourcesize, self.duration, self.fps = info
+        return poster
+
+    def getQImage(self):
         """
-        if not self.contents == "animation":
+        Returns: QImage object containing the still image data, the first
+        frame of an animation, or the poster frame of a video.
+        """
+        if self.contents not in ("image", "animation", "video"):
             return None
-        if self.qdata is None and not self.error:
-            root, file = self.path
-            img = QMovie(os.path.join(root, file))
-            if not img.isValid():
-                self.error = "failed to load: " + img.lastError()
+        if self.qdata is None and not self.error and not self.placeholder:
+            img = self.readPoster() if self.contents == "video" else self.readQImage()
+            if img.isNull():
+                self.error = self.error or "failed to load"
                 return None
-            img.setScaledSize(QSize(*self.fullsize))
             self.qdata = img
         return self.qdata
 
@@ -91,12 +258,11 @@ class GalleryObject(object):
         Returns: QImage object containing a sized image data.
         """
         if self.qpreview is None:
-            if self.contents == "image":
-                img = self.getQImage()
-                if img is not None:
-                    self.qpreview = self.fit(img, self.previewsize)
-            if self.contents == "animation":
-                self.qpreview = "PLACEHOLDER-FIXME!"
+            img = self.getQImage()
+            if img is not None:
+                t0 = time.time()
+                self.qpreview = self.fit(img, self.previewsize)
+                self.fittime += time.time() - t0
         return self.qpreview
 
     def load(self):
@@ -118,92 +284,672 @@ class GalleryObject(object):
         self.unload()
         self.qpreview = None
 
+    def sizeInBytes(self):
+        """
+        Returns: Approximate number of bytes of image data held in memory.
+        """
+        size = 0
+        for img in (self.qdata, self.qpreview):
+            if isinstance(img, QImage):
+                size += img.sizeInBytes()
+        return size
+
     def valid(self):
         """
         Try to load object and return True iff successful.
 
         Returns: True if the image can be loaded correctly.
         """
-        if self.contents == "image":
+        if self.contents in ("image", "animation", "video"):
             return self.getQImage() is not None
-        if self.contents == "animation":
-            return self.getQMovie() is not None
+
+
+class GalleryNotifier(QObject):
+    """
+    Signals from GalleryModel threads, delivered in the GUI thread.
+    """
+    imageLoaded = pyqtSignal(object)
 
 
 class GalleryModel(threading.Thread):
+    preloadCount = 10
+    prefetchWindow = 3
+    metadataBatch = 200
+    hashBatch = 32
+    hashInterval = 0.2
+
     def __init__(self, cfg):
         basepath = cfg.get("photos-basepath", ".")
         threading.Thread.__init__(self)
         self.cfg= cfg
         self.daemon = True
         self.basepath = basepath
-        self.categories = defaultdict(set)
+        self.catalogue = Catalogue()
+        self.categories = CategoryIndex(cfg.get("categories"), basepath)
         self.count = 0
-        self.loaded = {}
-        self.lock = threading.Lock()
-        self.history = deque()
-        self.cache = deque()
+        self.upcoming = deque()
+        self.metrics = Metrics()
+        self.metricsServer = None
+        # lock wait is the GUI thread's main exposure to the worker threads
+        self.lock = TimedLock(self.metrics.histogram("lock-wait"))
+        self.changed = threading.Condition(self.lock)
+        self.history = HistoryRing(cfg.get("history-size", 1000000))
+        # the stored history must not be overwritten before it was read back
+        self.historyLoaded = False
+        self.historyDirty = False
+        self.saveRequested = False
+        # (cycle, file id) of shown images, stored by the model thread
+        self.drawnPending = []
+        self.cache = ImageCache(cfg.get("cache-mb", 200) * 1e6)
         self.active = True
         self.paused = False
         self.idx = -1
+        self.direction = 1
+        self.prefetchWindow = max(1, cfg.get("prefetch-window", self.prefetchWindow))
+        self.pending = {}
+        # (priority, order) of the live queue entry of pending images that no
+        # worker has picked up yet; other entries for them are superseded
+        self.queued = {}
+        self.blockedState = None
+        self.previews = OrderedDict()
+        self.previewCount = cfg.get("preview-count", 100)
+        self.cache.onEvict = self.keepPreview
+        self.notifier = GalleryNotifier()
+        # decode requests are bounded by admission: preloadCount preloads, one
+        # request per image shown and the prefetch window around it
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        workers = cfg.get("decode-workers") or os.cpu_count() or 1
+        self.workers = [
+            threading.Thread(target=self.decodeLoop, name="decode-{}".format(ii), daemon=True)
+            for ii in range(workers)
+        ]
+        self.decodeStats = {"full": [0, 0.0], "reduced": [0, 0.0], "pixels-source": 0, "pixels-decoded": 0}
+        self.index = GalleryIndex(self.getDataPath("photos-index", "index-{}.sqlite"), mediaType)
+        self.metadataPending = threading.Event()
+        self.extractor = threading.Thread(target=self.metadataLoop, name="metadata", daemon=True)
+        self.duplicates = perceptualhash.DuplicateClusters(cfg.get("dedupe-distance", 8))
+        self.hashPending = threading.Event()
+        self.hasher = threading.Thread(target=self.hashLoop, name="hash", daemon=True)
+        self.watcher = None
+        self.rendercache = RenderCache(
+            self.getDataPath("render-cache-dir", "render-{}"),
+            cfg.get("render-cache-mb", 500) * 1e6,
+            quality=cfg.get("render-cache-quality", 95),
+        )
+        self.scanRate = 0.0
+        self.metrics.gauge("library-files", lambda: self.count)
+        self.metrics.gauge("scan-rate", lambda: self.scanRate)
+        self.metrics.gauge("upcoming", lambda: len(self.upcoming))
+        self.metrics.gauge("decode-queue", self.queue.qsize)
+        self.metrics.gauge("cache-hit-ratio", lambda: self.cache.hits / max(1, self.cache.hits + self.cache.misses))
+
+    def getDataPath(self, key, pattern):
+        """
+        Find where to keep persistent data for this library.
+
+        Args:
+            key: Config key that overrides the path.
+            pattern: Name within "data-dir" to use otherwise, where {} is replaced
+                by an identifier of the library.
+
+        Returns: Path of file or directory.
+        """
+        path = self.cfg.get(key)
+        if not path:
+            datadir = self.cfg.get("data-dir") or os.path.join(os.path.expanduser("~"), ".moframe")
+            digest = hashlib.sha1(os.path.abspath(self.basepath).encode("utf-8")).hexdigest()
+            path = os.path.join(datadir, pattern.format(digest[:12]))
+        return path
 
     def run(self):
         """
         Start listing and pre-loading images. Then continue to pre-load images as needed.
         """
-        for (root, dirs, files) in os.walk(self.basepath):
-            for file in files:
-                while self.paused and self.active:
-                    time.sleep(1.0)
-                if not self.active:
-                    return
-                # files with known extensions in dirs whose name do not start with underscore
-                if not os.path.split(root)[-1].startswith("_"):
-                    ext = file.rsplit(".", 1)[-1].lower()
-                    if ext in EXT_ALL:
-                        self.categories[""].add((root, file))
-                        self.count += 1
-                        if self.count % 10 == 0:
-                            self.preloadStep()
+        for worker in self.workers:
+            worker.start()
+        port = self.cfg.get("metrics-port")
+        if port:
+            try:
+                self.metricsServer = MetricsServer(self.metrics, port)
+                self.metricsServer.start()
+            except OSError as e:
+                print("Error: cannot serve metrics on port", port, e)
+        try:
+            self.scanLibrary()
+            if self.active:
+                self.extractor.start()
+                if self.duplicates.threshold and perceptualhash.numpy is None:
+                    print("Warning: numpy unavailable, near-duplicate photos are not suppressed")
+                elif self.duplicates.threshold:
+                    self.hasher.start()
+            mode = self.cfg.get("photos-watch", "auto")
+            if mode != "off" and self.active:
+                interval = self.cfg.get("photos-watch-interval", 300.0)
+                self.watcher = GalleryWatcher(self, mode=mode, interval=interval)
+                self.watcher.start()
+            while self.active:
+                with self.changed:
+                    self.changed.wait_for(lambda: self.saveRequested or self.drawnPending or self.needsPreload())
+                    save, self.saveRequested = self.saveRequested, False
+                    drawn = bool(self.drawnPending)
+                if drawn:
+                    self.saveDrawn()
+                if save:
+                    self.saveHistory()
+                    self.index.commit(force=True)
+                if save or drawn:
+                    continue
+                self.preloadStep()
+        finally:
+            self.stop()
+            for worker in self.workers:
+                worker.join()
+            if self.watcher:
+                self.watcher.join()
+            if self.extractor.is_alive():
+                self.extractor.join()
+            if self.hasher.is_alive():
+                self.hasher.join()
+            if self.metricsServer:
+                self.metricsServer.stop()
+            self.saveDrawn()
+            self.saveHistory()
+            self.index.close()
+
+    def saveHistory(self):
+        """
+        Store the history in the library index, if it was loaded from there
+        and has changed since.
+        """
+        with self.lock:
+            if not self.historyLoaded or not self.historyDirty:
+                return
+            data = self.history.tobytes()
+            self.historyDirty = False
+        self.index.setMeta("history", data)
+
+    def saveDrawn(self):
+        """
+        Store in the library index which images have been shown in which
+        shuffle cycle.
+        """
+        with self.lock:
+            rows, self.drawnPending = self.drawnPending, []
+        if rows:
+            self.index.markDrawn(rows)
+
+    def pause(self):
+        """
+        Stop pre-loading images until resumed. The history is saved by the
+        model thread, to keep the GUI thread free of database writes.
+        """
+        with self.changed:
+            self.paused = True
+            self.saveRequested = True
+            self.changed.notify_all()
+
+    def resume(self):
+        """
+        Resume pre-loading images.
+        """
+        with self.changed:
+            self.paused = False
+            self.changed.notify_all()
+
+    def stop(self):
+        """
+        Deactivate the model, cancelling all queued decodes.
+        """
+        with self.changed:
+            self.active = False
+            self.changed.notify_all()
+        self.metadataPending.set()
+        self.hashPending.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.workers:
+            self.queue.put((-1, next(self.sequence), None))
+
+    def requestDecode(self, fileid, priority, order=None):
+        """
+        Queue an image for decoding by the workers, unless it already is at
+        the same or a higher priority. Must be called with the lock held.
+
+        Args:
+            fileid: Catalogue id of the image.
+            priority: PRIORITY_SHOW or PRIORITY_PREFETCH to cache the image for
+                display, or PRIORITY_PRELOAD to add it to the upcoming images.
+            order: Optional rank among requests of the same priority, lowest
+                first, which re-queues an image queued with another rank.
+                Requests without one are served in the order they were made.
+        """
+        if fileid in self.pending:
+            if fileid not in self.queued:
+                # being decoded, the worker applies the raised priority when done
+                self.pending[fileid] = min(self.pending[fileid], priority)
+                return
+            if priority > self.pending[fileid]:
+                return
+            if priority == self.pending[fileid] and order in (None, self.queued[fileid][1]):
+                return
+        if order is None:
+            order = next(self.sequence)
+        self.pending[fileid] = priority
+        self.queued[fileid] = (priority, order)
+        self.queue.put((priority, order, fileid))
+
+    def decodeLoop(self):
+        """
+        Worker that decodes queued images and adds them to the cache, and
+        preloaded ones to the upcoming images.
+        """
         while self.active:
-            while self.paused and self.active:
-                time.sleep(1.0)
+            priority, order, fileid = self.queue.get()
+            if fileid is None or not self.active:
+                break
+            with self.changed:
+                if self.queued.get(fileid) != (priority, order):
+                    # re-queued at a higher priority
+                    continue
+                del self.queued[fileid]
+                current = fileid == self.getCurrentImageId()
+                if priority != PRIORITY_PRELOAD and (
+                    fileid in self.cache or (fileid not in self.cache.pinned and not current)
+                ):
+                    # navigation has moved on, or it was decoded meanwhile
+                    self.pending.pop(fileid, None)
+                    self.changed.notify_all()
+                    continue
+                if priority == PRIORITY_SHOW and not current:
+                    # passed by meanwhile, but still near enough to prefetch
+                    del self.pending[fileid]
+                    self.prefetch()
+                    continue
+                key = self.catalogue.key(fileid)
+                orientation = self.catalogue.orientations[fileid] if fileid in self.catalogue else 0
+            try:
+                img = self.loadImage(*key, orientation=orientation)
+                valid = img.valid()
+            except Exception as e:
+                # a failing decoder must not take the worker and pending preloads with it
+                img = GalleryObject(key, orientation=orientation)
+                img.error = "failed to decode: {}".format(e)
+                valid = False
+            img.fileid = fileid
+            with self.changed:
+                priority = self.pending.pop(fileid, priority)
+                if not valid:
+                    print("Error: bad image file:", img.contents, img.error)
+                    self.categories.discard(fileid)
+                if priority != PRIORITY_PRELOAD:
+                    # also cache failures, so that showing them does not retry
+                    self.cache.put(fileid, img)
+                elif valid and fileid in self.categories[""]:
+                    self.upcoming.append(fileid)
+                    self.cache.put(fileid, img)
+                    self.updatePins()
+                self.changed.notify_all()
+            self.notifier.imageLoaded.emit(fileid)
+
+    def metadataLoop(self):
+        """
+        Worker that extracts capture date, orientation and dimensions from the
+        headers of images in batches, storing them in the index and catalogue so
+        that each file is parsed once. Sleeps until files are added when done.
+        """
+        while self.waitUnpaused():
+            self.metadataPending.clear()
+            rows = self.index.listUnparsed(self.metadataBatch)
+            if not rows:
+                self.metadataPending.wait()
+                continue
+            t0 = time.perf_counter()
+            results = [(fileid, exif.readMetadata(os.path.join(root, file))) for fileid, root, file in rows]
+            self.index.storeMetadata(results)
+            with self.lock:
+                catalogue = self.catalogue
+                for fileid, meta in results:
+                    if fileid in catalogue:
+                        catalogue.setMetadata(fileid, meta.get("taken"), meta.get("orientation"))
+                        dirid = catalogue.dirs[fileid]
+                        self.categories.update(fileid, dirid, catalogue.roots[dirid], catalogue.taken[fileid])
+            self.metrics.observe("metadata-batch", time.perf_counter() - t0)
+            self.metrics.inc("metadata-parsed", len(rows))
+
+    def hashLoop(self):
+        """
+        Background job that computes perceptual hashes of images from small
+        previews, stores them in the index and clusters near-duplicates within
+        each directory. Only runs while preloading has nothing to do, and pauses
+        between batches, so that it never delays the slideshow.
+        """
+        if self.index.getMeta("phash-version") != perceptualhash.HASH_VERSION:
+            # hashed from other pixels by an older version
+            self.index.clearHashes()
+            self.index.setMeta("phash-version", perceptualhash.HASH_VERSION)
+        for dirid, rows in itertools.groupby(self.index.listHashes(), key=lambda row: row[0]):
+            if not self.active:
+                return
+            self.clusterDir(dirid, [row[1:] for row in rows])
+        while self.waitIdle():
+            self.hashPending.clear()
+            rows = self.index.listUnhashed(self.hashBatch)
+            if not rows:
+                self.hashPending.wait()
+                continue
+            t0 = time.perf_counter()
+            results, hashed, pixels, dirids = [], [], [], set()
+            for fileid, dirid, root, file in rows:
+                with self.lock:
+                    if not self.active or not self.isIdle():
+                        break
+                preview = self.getHashPreview(fileid, root, file)
+                if preview is None:
+                    results.append((fileid, 0))
+                else:
+                    hashed.append(fileid)
+                    pixels.append(perceptualhash.grayPixels(preview))
+                dirids.add(dirid)
+            if pixels:
+                hashes = perceptualhash.phashBatch(perceptualhash.numpy.stack(pixels))
+                results.extend((fileid, perceptualhash.toSigned(h)) for fileid, h in zip(hashed, hashes))
+            self.index.storeHashes(results)
+            for dirid in dirids:
+                self.clusterDir(dirid, [row[1:] for row in self.index.listHashes(dirid)])
+            self.metrics.observe("hash-batch", time.perf_counter() - t0)
+            self.metrics.inc("hashed", len(results))
+            time.sleep(self.hashInterval)
+
+    def getHashPreview(self, fileid, root, file):
+        """
+        Find the small preview of an image to hash: the one of the decoded image
+        or the retained one if still in memory, otherwise a freshly rendered one,
+        made the same way but bypassing the render cache.
+
+        Returns: Preview QImage, or None if the image cannot be decoded.
+        """
+        with self.lock:
+            obj = self.cache.peek(fileid)
+            preview = obj.qpreview if obj is not None else None
+            if not isinstance(preview, QImage):
+                preview = self.previews.get(fileid)
+            orientation = self.catalogue.orientations[fileid] if fileid in self.catalogue else 0
+        if preview is None:
+            obj = GalleryObject((root, file), orientation=orientation)
+            if "target-size" in self.cfg:
+                obj.fullsize = tuple(self.cfg["target-size"])
+            preview = obj.getQPreview()
+        return preview
+
+    def clusterDir(self, dirid, rows):
+        """
+        Recompute the near-duplicate clusters of one directory.
+
+        Args:
+            dirid: Catalogue id of the directory.
+            rows: List of (file id, signed hash) of its hashed images.
+        """
+        fileids = [fileid for fileid, h in rows]
+        clusters = self.duplicates.cluster(fileids, [h for fileid, h in rows])
+        with self.lock:
+            clusters = [[f for f in cluster if f in self.catalogue] for cluster in clusters]
+            self.duplicates.setGroup(fileids, [cluster for cluster in clusters if len(cluster) > 1])
+
+    def isIdle(self):
+        """
+        Must be called with the lock held.
+
+        Returns: True iff the model is deactivated, or is running and has all
+        upcoming images decoded and no decodes outstanding.
+        """
+        if not self.active:
+            return True
+        return (
+            not self.paused and not self.pending
+            and len(self.upcoming) >= min(self.preloadCount, len(self.categories[""]))
+        )
+
+    def waitIdle(self):
+        """
+        Block until background work does not compete with the slideshow.
+
+        Returns: True iff the model is still active.
+        """
+        with self.changed:
+            self.changed.wait_for(self.isIdle)
+            return self.active
+
+    def waitUnpaused(self):
+        """
+        Block while paused.
+
+        Returns: True iff the model is still active.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: not self.paused or not self.active)
+            return self.active
+
+    def scanLibrary(self):
+        """
+        Load the library index and start pre-loading images, then reconcile the
+        index with the file system, rescanning only directories that changed.
+        """
+        t0 = time.perf_counter()
+        dirs, files = self.index.load()
+        history = self.index.getMeta("history", b"")
+        with self.lock:
+            catalogue = self.catalogue
+            self.categories[""].cycle = self.index.getMeta("cycle", 0)
+            for dirid, root in dirs:
+                catalogue.addDir(dirid, root)
+            if files:
+                catalogue.reserve(files[-1][0])
+            roots = catalogue.roots
+            for fileid, dirid, file, drawn, taken, orientation in files:
+                catalogue.add(fileid, dirid, file, taken, orientation)
+                self.categories.add(fileid, dirid, roots[dirid], taken, drawn=drawn)
+            self.count = len(catalogue)
+            self.history.frombytes(history, keep=catalogue.__contains__)
+            self.historyLoaded = True
+        del dirs, files
+        self.metrics.observe("index-load", time.perf_counter() - t0)
+        for _ in range(10):
             self.preloadStep()
-            time.sleep(0.1)
+        t0 = time.perf_counter()
+        for event, row in self.index.scan(self.basepath):
+            if not self.waitUnpaused():
+                return
+            self.applyChange(event, row)
+            if event == "add" and self.count % 10 == 0:
+                self.preloadStep()
+        seconds = time.perf_counter() - t0
+        self.metrics.observe("scan", seconds)
+        self.scanRate = self.count / seconds if seconds > 0 else 0.0
+
+    def applyChange(self, event, row):
+        """
+        Apply a change in the library to the in-memory catalogue.
+
+        Args:
+            event: "add", "remove" or "change".
+            row: (file id, dir id, root, file) of the affected file.
+        """
+        fileid, dirid, root, file = row
+        self.metrics.inc("library-" + event)
+        with self.changed:
+            if event == "add":
+                self.catalogue.addDir(dirid, root)
+                if self.catalogue.add(fileid, dirid, file):
+                    self.categories.add(fileid, dirid, root)
+            elif event == "change":
+                if fileid in self.catalogue:
+                    # drop stale decodes, and give files that failed while
+                    # being written another chance
+                    if fileid in self.upcoming:
+                        self.upcoming.remove(fileid)
+                    self.cache.discard(fileid)
+                    self.previews.pop(fileid, None)
+                    self.categories.add(fileid, dirid, root)
+            elif self.catalogue.remove(fileid):
+                self.categories.discard(fileid)
+                if fileid in self.upcoming:
+                    self.upcoming.remove(fileid)
+                self.cache.discard(fileid)
+                self.previews.pop(fileid, None)
+                self.duplicates.discard(fileid)
+            self.count = len(self.catalogue)
+            self.changed.notify_all()
+        if event != "remove":
+            self.metadataPending.set()
+
+    def needsPreload(self):
+        """
+        Condition predicate for the pre-loading loop. Must be called with the
+        lock held.
+
+        Returns: True iff the model is deactivated, or more images should and
+        can be queued for decoding.
+        """
+        if not self.active:
+            return True
+        busy = self.getPreloadCount()
+        return (
+            not self.paused and busy < self.preloadCount and len(self.categories[""]) > busy
+            and self.blockedState != (busy, len(self.pending), self.count)
+        )
 
     def preloadStep(self):
         """
-        Preload one image from the collection.
+        Queue one image from the collection for preloading by the decode workers.
+
+        Returns: True iff an image was queued.
         """
-        if len(self.loaded) < 10:
-            with self.lock:
-                candidates = self.categories[""] - set(self.loaded)
-                if candidates:
-                    root, file = random.choice(tuple(candidates))
-                    img = self.loadImage(root, file)
-                    if not img.valid():
-                        print("Error: bad image file:", img.contents, img.error)
-                        self.categories[""].remove((root, file))
-                    else:
-                        self.loaded[(root, file)] = img
-
-    def loadImage(self, root, file):
+        if self.categories.needsRefresh():
+            self.refreshCategories()
+        with self.lock:
+            busy = self.getPreloadCount()
+            if not self.active or busy >= self.preloadCount:
+                return False
+            bag = self.categories[""]
+            cycle = bag.cycle
+            fileid = None
+            for attempt in range(2 * (busy + 1)):
+                # fall back to all files if the weighted categories only hold queued ones
+                candidate = self.categories.draw(fallback=attempt > busy)
+                if candidate is not None and candidate not in self.upcoming and candidate not in self.pending:
+                    fileid = candidate
+                    break
+            if fileid is None:
+                # wait for the queue or the library to change before trying again, the
+                # draws may have hit images that are pending for display
+                self.blockedState = (busy, len(self.pending), self.count)
+                return False
+            self.blockedState = None
+            # at most one image of a cluster of near-duplicates per cycle
+            for sibling in self.duplicates.siblings(fileid):
+                self.categories.markDrawn(sibling)
+            if fileid in self.cache:
+                # still in memory from an earlier showing
+                self.upcoming.append(fileid)
+                self.updatePins()
+            else:
+                self.requestDecode(fileid, PRIORITY_PRELOAD)
+        if bag.cycle != cycle:
+            self.index.setMeta("cycle", bag.cycle)
+        return True
+
+    def refreshCategories(self):
+        """
+        Recompute date-based categories such as "on this day" for the current
+        date. The catalogue is only scanned outside the lock.
+        """
+        now = localNow()
+        with self.lock:
+            snapshot = CategoryIndex.snapshot(self.catalogue)
+        members = self.categories.collectDateBased(snapshot, now)
+        with self.lock:
+            self.categories.replaceDateBased(members, now, self.catalogue.__contains__)
+
+    def getPreloadCount(self):
+        """
+        Returns: Number of images preloaded or being preloaded. Must be called
+        with the lock held.
+        """
+        return len(self.upcoming) + sum(1 for p in self.pending.values() if p == PRIORITY_PRELOAD)
+
+    def loadImage(self, root, file, orientation=0):
         """
         Load image from disk.
 
         Args:
             root: Full path of directory.
             file: Filename.
+            orientation: EXIF orientation if known from the index, otherwise 0
+                to read it from the file.
 
         Returns:
             QImage: image.
         """
-        obj = GalleryObject((root, file))
+        t0 = time.perf_counter()
+        obj = GalleryObject((root, file), orientation=orientation)
         if "target-size" in self.cfg:
-            obj.fullsize = self.cfg["target-size"]
+            obj.fullsize = tuple(self.cfg["target-size"])
+        obj.framebudget = self.cfg.get("animation-mb", 100) * 1e6
+        cachekey = None
+        if obj.contents == "image":
+            path = os.path.join(root, file)
+            try:
+                st = os.stat(path)
+                cachekey = self.rendercache.makeKey(path, st.st_mtime, st.st_size, obj.fullsize)
+                obj.qdata = self.rendercache.get(cachekey)
+            except OSError:
+                pass
         obj.load()
+        self.metrics.observe("fit", obj.fittime)
+        if obj.sourcesize:
+            # decoded from the original file rather than served from cache
+            if cachekey and obj.qdata is not None:
+                self.rendercache.put(cachekey, obj.qdata)
+            self.metrics.observe("decode-" + obj.contents, obj.decodetime)
+        if obj.sourcesize and obj.contents == "image":
+            with self.lock:
+                stats = self.decodeStats
+                entry = stats["reduced" if obj.reduced else "full"]
+                entry[0] += 1
+                entry[1] += obj.decodetime
+                stats["pixels-source"] += obj.sourcesize[0] * obj.sourcesize[1]
+                stats["pixels-decoded"] += obj.fullsize[0] * obj.fullsize[1] if obj.reduced else \
+                    obj.sourcesize[0] * obj.sourcesize[1]
+        self.metrics.observe("load", time.perf_counter() - t0)
         return obj
 
+    def getStatus(self):
+        """
+        Returns: Dictionary describing how much decoding work was saved by
+        decoding images at reduced size or serving them from the render cache,
+        and latencies and throughput of the pipeline stages.
+        """
+        stats = self.decodeStats
+        status = {}
+        for kind in ("full", "reduced"):
+            count, seconds = stats[kind]
+            status["decode-" + kind] = "{} images, {:.0f} ms avg".format(
+                count, 1000.0 * seconds / count if count else 0.0)
+        if stats["pixels-source"]:
+            status["decode-pixels-saved"] = "{:.0f}%".format(
+                100.0 - 100.0 * stats["pixels-decoded"] / stats["pixels-source"])
+        status.update(self.cache.getStatus())
+        status.update(self.rendercache.getStatus())
+        with self.lock:
+            status.update(self.categories.getStatus())
+            status.update(self.duplicates.getStatus())
+        status.update(self.metrics.getStatus())
+        return status
+
     def nextImage(self):
         """
         Designate next image, put it on the history-queue and return it.
@@ -213,7 +959,11 @@ class GalleryModel(threading.Thread):
         """
         if self.idx <= 0:
             self.addImage()
-        self.idx = max(0, self.idx - 1)
+        with self.lock:
+            self.idx = max(0, self.idx - 1)
+            self.direction = 1
+            self.updatePins()
+            self.prefetch()
         item = self.getCurrentImage()
         return item
 
@@ -224,7 +974,11 @@ class GalleryModel(threading.Thread):
         Returns:
             (str, str, QImage): (root, filename, image)
         """
-        self.idx = min(len(self.history) - 1, self.idx + 1)
+        with self.lock:
+            self.idx = min(len(self.history) - 1, self.idx + 1)
+            self.direction = -1
+            self.updatePins()
+            self.prefetch()
         item = self.getCurrentImage()
         return item
 
@@ -249,30 +1003,91 @@ class GalleryModel(threading.Thread):
         Returns:
             (str, str, QImage): (root, filename, image)
         """
-        if len(self.history) == 0:
-            print("Error: no images to display")
-            return None, None, None
-        elif len(self.history) <= self.idx:
-            print("Error: invalid image index")
-            return None, None, None
-        else:
-            key = self.getCurrentImageKey()
-            for kk, ii in self.cache:
-                if key == kk:
-                    item = (kk, ii)
-                    break
-            else:
-                item = (key, self.loadImage(*key))
-        return item[0] + (item[1],)
+        with self.lock:
+            if len(self.history) == 0:
+                print("Error: no images to display")
+                return None, None, None
+            elif len(self.history) <= self.idx:
+                print("Error: invalid image index")
+                return None, None, None
+            fileid = self.getCurrentImageId()
+            img = self.cache.get(fileid)
+            if img is None:
+                self.metrics.inc("show-miss")
+                img = self.getPlaceholder(fileid)
+                self.requestDecode(fileid, PRIORITY_SHOW)
+            key = self.catalogue.key(fileid)
+        return key + (img,)
+
+    def getPlaceholder(self, fileid):
+        """
+        Make a stand-in for an image that is still being decoded, showing its
+        preview if one is still known. Must be called with the lock held.
+
+        Returns: GalleryObject that will not decode anything itself.
+        """
+        obj = GalleryObject(self.catalogue.key(fileid), fileid=fileid, contents="image", placeholder=True)
+        if "target-size" in self.cfg:
+            obj.fullsize = tuple(self.cfg["target-size"])
+        preview = self.previews.get(fileid)
+        if preview is not None:
+            obj.qdata = obj.fit(preview, obj.fullsize)
+        return obj
+
+    def keepPreview(self, fileid, obj):
+        """
+        Retain the preview of an image evicted from the cache, for use as a
+        placeholder. Must be called with the lock held.
+        """
+        if isinstance(obj.qpreview, QImage):
+            self.previews[fileid] = obj.qpreview
+            self.previews.move_to_end(fileid)
+            while len(self.previews) > self.previewCount:
+                self.previews.popitem(last=False)
+
+    def updatePins(self):
+        """
+        Pin upcoming images, and the current image and the prefetch window
+        around it in the history, in the cache. Must be called with the lock held.
+        """
+        pinned = set(self.upcoming)
+        current = len(self.history) - 1 - max(0, self.idx)
+        for ii in range(current - self.prefetchWindow, current + self.prefetchWindow + 1):
+            if 0 <= ii < len(self.history):
+                pinned.add(self.history[ii])
+        self.cache.pin(pinned)
+
+    def prefetch(self):
+        """
+        Request decoding of history images within the prefetch window of the
+        current image that are not cached, nearest first, those in the direction
+        of travel before those behind. Images already queued are re-ranked, as
+        the position or direction changed. Must be called with the lock held.
+        """
+        current = len(self.history) - 1 - max(0, self.idx)
+        for rank, direction in enumerate((self.direction, -self.direction)):
+            for distance in range(1, self.prefetchWindow + 1):
+                ii = current + direction * distance
+                if 0 <= ii < len(self.history) and self.history[ii] not in self.cache:
+                    self.requestDecode(self.history[ii], PRIORITY_PREFETCH, rank * self.prefetchWindow + distance)
 
     def getCurrentImageKey(self):
+        """
+        Returns: (root, file) of current image.
+        """
+        return self.catalogue.key(self.getCurrentImageId())
+
+    def getCurrentImageId(self):
+        """
+        Returns: Catalogue id of current image, or None.
+        """
         if len(self.history) > max(0, self.idx):
             return self.history[self.getCurrentImageIndex()]
-        return ("", "")
+        return None
 
     def getCurrentImageIndex(self):
         """
-        Index in dequeue where the most recent is always zero.
+        Index in history where the most recent is always -1.
         """
         return -1 - self.idx
 
@@ -287,17 +1102,18 @@ class GalleryModel(threading.Thread):
         Select a new image from the preloaded cache and move it to the front of
         the history.
         """
-        if len(self.loaded) == 0:
-            print("No new image available.")
-            return
-        with self.lock:
-            item = self.loaded.popitem()
-            self.cache.append(item)
-            self.history.append(item[0])
-            while len(self.history) > 10000:
-                self.history.popleft()
-            while len(self.cache) > 10:
-                self.cache.popleft()
+        with self.changed:
+            if len(self.upcoming) == 0:
+                print("No new image available.")
+                return
+            fileid = self.upcoming.popleft()
+            self.history.append(fileid)
+            self.historyDirty = True
+            self.updatePins()
+            cycle = self.categories[""].cycle
+            # stored by the model thread, to keep the GUI thread free of database writes
+            self.drawnPending.extend((cycle, drawn) for drawn in [fileid] + self.duplicates.siblings(fileid))
+            self.changed.notify_all()
 
 
 
@@ -0,0 +1,235 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import struct
+import threading
+import time
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    # files written in place, or finished after being created, and permission changes
+    | IN_CLOSE_WRITE | IN_ATTRIB
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def loadLibC():
+    """
+    Returns: ctypes handle to a C library providing inotify, or None.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class WatchLimitError(OSError):
+    pass
+
+
+class GalleryWatcher(threading.Thread):
+    """
+    Keep the catalogue of a GalleryModel current after the initial scan.
+
+    Changed directories are found with inotify where available, otherwise by
+    periodically comparing directory mtimes against the library index. Either
+    way only changed directories are listed, and the resulting add and remove
+    deltas are applied to the model. A renamed file or directory appears as a
+    removal followed by an addition.
+    """
+    settleTime = 1.0
+    maxDelay = 10.0
+
+    def __init__(self, model, mode="auto", interval=300.0):
+        """
+        Args:
+            model: GalleryModel whose catalogue and index are to be updated.
+            mode: One of "auto", "inotify" or "poll".
+            interval: Seconds between scans when polling.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.model = model
+        self.mode = mode
+        self.interval = interval
+        self.libc = None
+        self.fd = -1
+        self.watches = {}
+        self.wds = {}
+
+    def run(self):
+        """
+        Watch the library until the model is deactivated.
+        """
+        if self.mode in ("auto", "inotify"):
+            self.libc = loadLibC()
+            if self.libc is None:
+                print("Warning: inotify unavailable, polling photo library for changes")
+            else:
+                try:
+                    self.runInotify()
+                except OSError as e:
+                    print("Warning: inotify failed, polling photo library for changes:", e)
+                finally:
+                    self.closeInotify()
+        if self.model.active:
+            self.runPoll()
+
+    def runPoll(self):
+        """
+        Periodically rescan the library, listing only directories whose mtime changed.
+        """
+        lastScan = time.time()
+        while self.model.active:
+            time.sleep(1.0)
+            if not self.model.paused and time.time() - lastScan > self.interval:
+                self.rescan(self.model.basepath)
+                lastScan = time.time()
+
+    def runInotify(self):
+        """
+        Watch every library directory with inotify and rescan directories that
+        report changes, once they have settled. Those directories are listed
+        even if their mtime is unchanged, as writing a file does not change it.
+        """
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.syncWatches(self.model.basepath)
+        dirty = set()
+        firstDirty = lastEvent = 0.0
+        while self.model.active:
+            ready, _, _ = select.select([self.fd], [], [], self.settleTime)
+            now = time.time()
+            if ready:
+                changed = self.readEvents()
+                if changed and not dirty:
+                    firstDirty = now
+                dirty.update(changed)
+                lastEvent = now
+            if dirty and (now - lastEvent >= self.settleTime or now - firstDirty >= self.maxDelay):
+                for root in self.collapse(dirty):
+                    self.rescan(root, dirty)
+                    self.syncWatches(root)
+                dirty.clear()
+
+    def closeInotify(self):
+        """
+        Release the inotify file descriptor and all its watches.
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+        self.fd = -1
+        self.watches.clear()
+        self.wds.clear()
+
+    def readEvents(self):
+        """
+        Returns: Set of directories that reported a change.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        dirty = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                dirty.add(self.model.basepath)
+                continue
+            root = self.watches.get(wd)
+            if root is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                if self.wds.get(root) == wd:
+                    del self.wds[root]
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                dirty.add(os.path.dirname(root))
+            else:
+                dirty.add(root)
+        return dirty
+
+    @staticmethod
+    def collapse(roots):
+        """
+        Returns: Sorted roots, leaving out those that are inside another one.
+        """
+        result = []
+        for root in sorted(roots):
+            if not any(root.startswith(os.path.join(parent, "")) for parent in result):
+                result.append(root)
+        return result
+
+    def addWatch(self, root):
+        """
+        Start watching a directory.
+
+        Raises:
+            WatchLimitError: if the kernel limit on watches is reached.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchLimitError(err, "inotify watch limit reached, see fs.inotify.max_user_watches")
+            return
+        old = self.watches.get(wd)
+        if old is not None and self.wds.get(old) == wd:
+            del self.wds[old]
+        self.watches[wd] = root
+        self.wds[root] = wd
+
+    def syncWatches(self, basepath):
+        """
+        Make the set of watched directories below basepath match the index.
+        """
+        known = set(self.model.index.listDirs(basepath))
+        prefix = os.path.join(basepath, "")
+        for root in [r for r in self.wds if r == basepath or r.startswith(prefix)]:
+            if root not in known:
+                wd = self.wds.pop(root)
+                self.watches.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+        for root in known:
+            if root not in self.wds:
+                self.addWatch(root)
+
+    def rescan(self, root, forced=()):
+        """
+        Reconcile a part of the library with the file system and apply changes
+        to the model.
+
+        Args:
+            root: Directory to rescan, with its sub-directories.
+            forced: Directories to list even if their mtime is unchanged.
+        """
+        if root != self.model.basepath and not root.startswith(os.path.join(self.model.basepath, "")):
+            return
+        for event, row in self.model.index.scan(root, forced):
+            if not self.model.active:
+                return
+            self.model.applyChange(event, row)
@@ -1,5 +1,5 @@
 from PyQt5 import QtCore
-from PyQt5.QtWidgets import QVBoxLayout, QWidget, QLabel
+from PyQt5.QtWidgets import QVBoxLayout, QWidget
 from PyQt5.QtCore import QSize, Qt, QTimer
 
 from moframe.basewidget import BaseWidget
@@ -14,15 +14,26 @@ class GalleryWidget(BaseWidget):
         QWidget.__init__(self, parent)
         self.config = cfg or {}
         self.imagemodel = GalleryModel(cfg)
+        self.imagemodel.notifier.imageLoaded.connect(self.imageLoaded)
         self.imagemodel.start()
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update)
         self.photoframe = ImageWidget(self)
-        self.movieframe = QLabel(self)
+        self.photoframe.metrics = self.imagemodel.metrics
+        self.photoframe.videoBuffer = self.config.get("video-buffer-frames", 8)
+        self.photoframe.setTransition(
+            self.config.get("transition", "fade"),
+            self.config.get("transition-duration", 0.5),
+            self.config.get("transition-fps", 30.0),
+        )
+        self.metricstimer = QTimer(self)
+        self.metricstimer.timeout.connect(lambda: print(self.imagemodel.metrics.logLine()))
+        interval = self.config.get("metrics-log-interval", 600.0)
+        if interval:
+            self.metricstimer.start(int(interval * 1000))
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
         layout.addWidget(self.photoframe)
-        layout.addWidget(self.movieframe)
         self.delayMultiplier = 1000.0
 
     def buttonName(self):
@@ -44,34 +55,67 @@ class GalleryWidget(BaseWidget):
         else:
             root, filename, img = self.imagemodel.nextImage()
         if img:
-            if img.contents == "image":
-                self.photoframe.setImage(img)
-                self.movieframe.hide()
-                self.photoframe.show()
-            elif img.contents == "animation":
-                img.unload()
-                movie = img.getQMovie()
-                self.movieframe.setMovie(movie)
-                movie.start()
-                self.photoframe.hide()
-                self.movieframe.show()
-            self.timer.setInterval(self.getDelay())
+            self.showImage(img)
+            self.timer.setInterval(int(self.getDisplayTime(img)))
+
+    def showImage(self, img, animate=True):
+        """
+        Display an image or animation.
+
+        Args:
+            img: GalleryObject to display.
+            animate: If False, cut to the image without a transition.
+        """
+        if img.contents in ("image", "animation", "video"):
+            # leave at least half of the display time for the still image
+            self.photoframe.setImage(
+                img, animate=animate, duration=self.getDelay() / 2000.0,
+                displayTime=self.getDisplayTime(img) / 1000.0,
+            )
+            self.photoframe.show()
+
+    def imageLoaded(self, fileid):
+        """
+        Replace a placeholder with the real image once it has been decoded.
+
+        Args:
+            fileid: Catalogue id of the decoded image.
+        """
+        shown = self.photoframe.image
+        if shown is not None and shown.placeholder and shown.fileid == fileid:
+            if fileid == self.imagemodel.getCurrentImageId():
+                root, filename, img = self.imagemodel.getCurrentImage()
+                if img is not None and not img.placeholder:
+                    self.showImage(img, animate=False)
+                    if img.contents == "video":
+                        # play the video for its length from now
+                        self.timer.setInterval(int(self.getDisplayTime(img)))
 
     def getDelay(self):
         return self.config.get("photos-delay", 1.0) * self.delayMultiplier
 
+    def getDisplayTime(self, img):
+        """
+        Returns: Milliseconds to show an image for. Videos are shown for their
+        length, up to video-max-duration seconds, but not shorter than the delay.
+        """
+        delay = self.getDelay()
+        if img.contents == "video" and img.duration:
+            delay = max(delay, 1000.0 * min(img.duration, self.config.get("video-max-duration", 60.0)))
+        return delay
+
     def start(self):
         """
         Start or resume widget.
         """
-        self.imagemodel.paused = False
+        self.imagemodel.resume()
         self.timer.start(100)
 
     def pause(self):
         """
         Temporarily stop the widget from updating.
         """
-        self.imagemodel.paused = True
+        self.imagemodel.pause()
         self.timer.stop()
 
     def stop(self):
@@ -79,7 +123,8 @@ class GalleryWidget(BaseWidget):
         Stop the gallery widget.
         """
         self.pause()
-        self.imagemodel.active = False
+        self.photoframe.stopVideo()
+        self.imagemodel.stop()
         self.imagemodel.join()
 
     def next(self):
@@ -87,14 +132,16 @@ class GalleryWidget(BaseWidget):
         Handle "next" command if applicable.
         """
         root, filename, img = self.imagemodel.nextImage()
-        self.photoframe.setImage(img)
+        if img:
+            self.showImage(img)
 
     def previous(self):
         """
         Handle "previous" command if applicable.
         """
         root, filename, img = self.imagemodel.prevImage()
-        self.photoframe.setImage(img)
+        if img:
+            self.showImage(img)
 
     def faster(self):
         """
@@ -133,7 +180,7 @@ class GalleryWidget(BaseWidget):
         """
         Return status information as a dictionary.
         """
-        return {
+        status = {
             "speed": "%s" % (60000.0 / self.getDelay()),
             "speed-unit": "photos per minute",
             "current-image-idx": "{} of {}".format(
@@ -142,6 +189,8 @@ class GalleryWidget(BaseWidget):
             ),
             "current-image-name": self.imagemodel.getCurrentImageKey()[1],
         }
+        status.update(self.imagemodel.getStatus())
+        return status
 
 
 
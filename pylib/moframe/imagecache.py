@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+
+class ImageCache(object):
+    """
+    In-memory cache of decoded GalleryObjects, limited by the number of bytes
+    their images occupy. Least recently used entries are evicted first, except
+    for pinned ones such as the current image and its neighbours.
+
+    Not thread-safe, callers must serialize access.
+    """
+    onEvict = None
+
+    def __init__(self, budget):
+        """
+        Args:
+            budget: Maximum number of image bytes to keep, unless pinned.
+        """
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.pinned = set()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+        Returns: Cached object for key, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def peek(self, key):
+        """
+        Returns: Cached object for key, or None, without counting the lookup or
+        refreshing its use.
+        """
+        entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def put(self, key, obj):
+        """
+        Add or replace an object, then evict as needed.
+
+        Args:
+            key: Hashable key.
+            obj: GalleryObject.
+        """
+        self.discard(key)
+        size = obj.sizeInBytes()
+        self.entries[key] = (obj, size)
+        self.total += size
+        self.evict()
+
+    def discard(self, key):
+        """
+        Remove an object if present.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total -= entry[1]
+
+    def pin(self, keys):
+        """
+        Replace the set of keys that are never evicted.
+        """
+        self.pinned = set(keys)
+        self.evict()
+
+    def evict(self):
+        """
+        Drop least recently used objects that are not pinned, until within budget.
+        """
+        if self.total <= self.budget:
+            return
+        for key in list(self.entries):
+            if self.total <= self.budget:
+                break
+            if key not in self.pinned:
+                obj = self.entries[key][0]
+                self.discard(key)
+                if self.onEvict:
+                    self.onEvict(key, obj)
+
+    def getStatus(self):
+        """
+        Returns: Dictionary describing cache usage.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "memory-cache": "{} images, {:.0f} of {:.0f} MB, {:.0f}% hits".format(
+                len(self.entries), self.total / 1e6, self.budget / 1e6,
+                100.0 * self.hits / lookups if lookups else 0.0),
+        }
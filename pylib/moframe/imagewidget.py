@@ -1,44 +1,492 @@
+import os.path
+import threading
+import time
+
 from PyQt5.QtWidgets import QWidget
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPainter, QColor, QFont, QBrush
+from PyQt5.QtCore import Qt, QRect, QRectF, QTimer, pyqtSignal
+from PyQt5.QtGui import QPainter, QColor, QFont, QPixmap
+
+from moframe.videoplayer import VideoDecoder
+
+TRANSITIONS = ("none", "fade", "slide", "kenburns")
+
 
 class ImageWidget(QWidget):
+    """
+    Displays a GalleryObject. The image is converted to a screen-format pixmap
+    with the darkening already composited in once, so that repainting any part
+    of the widget, e.g. below an overlay, is a plain copy of that part.
+
+    Animations show their poster frame until all frames have been decoded on a
+    separate thread, and only the shown animation's frames are held, each as a
+    pixmap once first painted. Videos are decoded ahead on a separate thread
+    and presented by the clock, dropping late frames rather than falling behind.
+
+    Changing the image can be animated by a transition. Transition frames are
+    timed by the clock rather than counted, so frames are skipped instead of
+    slowing the transition down when painting falls behind, and transitions are
+    replaced by hard cuts for a while if frames take longer than the frame
+    budget; each transition after that is measured anew. The "kenburns"
+    transition fades in still images and then keeps slowly zooming out of and
+    panning across them for as long as they are displayed, repainting only as
+    often as the motion moves by about a pixel; its frames are measured the
+    same way, and falling back to hard cuts also stops the motion.
+    """
     image = None
     darkenBy = 0x00
+    metrics = None
+    pixmap = None
+    pixmapKey = None
+    transition = "none"
+    transitionDuration = 0.5
+    frameBudget = 1.0 / 30
+    minFrames = 3
+    # seconds to use hard cuts for after transition frames took too long
+    hardCutCooldown = 300.0
+    # Ken Burns zoom at the start of the display time, and where the zoom is
+    # anchored for successive images
+    motionZoom = 1.12
+    motionAnchors = ((0.35, 0.35), (0.65, 0.35), (0.65, 0.65), (0.35, 0.65))
+    videoBuffer = 8
+    framesLoaded = pyqtSignal(object, object)
+
+    def __init__(self, parent=None):
+        QWidget.__init__(self, parent)
+        self.outgoing = None
+        self.transitionStart = 0.0
+        self.activeDuration = self.transitionDuration
+        self.paintedFrames = 0
+        self.skippedFrames = 0
+        self.frameTime = 0.0
+        self.hardCutUntil = 0.0
+        self.motionStart = 0.0
+        self.motionDuration = 0.0
+        self.motionCount = 0
+        self.frametimer = QTimer(self)
+        self.frametimer.timeout.connect(self.frameTick)
+        self.frameIndex = 0
+        self.animationFrames = None
+        # animation whose frames are to be decoded next, and the one being decoded
+        self.framesRequest = None
+        self.framesLoading = None
+        self.framesRequested = threading.Condition()
+        self.frameloader = None
+        self.framesLoaded.connect(self.setFrames)
+        self.animtimer = QTimer(self)
+        self.animtimer.setSingleShot(True)
+        self.animtimer.timeout.connect(self.nextFrame)
+        self.decoder = None
+        self.videoFrame = None
+        self.videoDropped = 0
+        self.videotimer = QTimer(self)
+        self.videotimer.timeout.connect(self.videoTick)
+
+    def setTransition(self, transition, duration=0.5, fps=30.0):
+        """
+        Choose how image changes are animated.
+
+        Args:
+            transition: One of "none", "fade", "slide" or "kenburns", which
+                also pans and zooms still images while they are displayed.
+            duration: Seconds a transition lasts.
+            fps: Frame rate to aim for, which sets the frame budget.
+        """
+        if transition not in TRANSITIONS:
+            print("Error: unknown transition:", transition)
+            transition = "none"
+        self.transition = transition
+        self.transitionDuration = duration
+        self.frameBudget = 1.0 / max(1.0, fps)
 
-    def setImage(self, img):
+    def setImage(self, img, animate=True, duration=None, displayTime=None):
         """
         Change which image is displayed.
 
         Args:
             img (QImage): A valid image to display.
+            animate: If False, cut to the image without a transition.
+            duration: Optional upper limit on the transition in seconds.
+            displayTime: Seconds the image will be displayed for, over which
+                the "kenburns" transition pans and zooms still images.
         """
+        outgoing = self.getPixmap() if self.isVisible() else None
         self.image = img
-        self.repaint()
+        self.outgoing = None
+        self.motionDuration = 0.0
+        self.startAnimation()
+        self.startVideo()
+        hardCut = time.perf_counter() < self.hardCutUntil
+        if (
+            self.transition == "kenburns" and displayTime and not hardCut and img.contents == "image"
+            and not img.placeholder and self.isVisible()
+        ):
+            self.motionStart = time.perf_counter()
+            self.motionDuration = displayTime
+            self.motionCount += 1
+            self.paintedFrames = self.skippedFrames = 0
+        if animate and outgoing is not None and self.transition != "none" and not hardCut:
+            duration = min(self.transitionDuration, duration or self.transitionDuration)
+            if duration > self.frameBudget and self.getPixmap() is not None:
+                # converted now rather than in the first frame
+                self.outgoing = outgoing
+                self.activeDuration = duration
+                self.transitionStart = time.perf_counter()
+                self.paintedFrames = self.skippedFrames = 0
+                self.frametimer.start(int(1000 * self.frameBudget))
+        if self.outgoing is None:
+            self.startMotion()
+        self.update()
+
+    def frameTick(self):
+        """
+        Schedule the next transition or motion frame, or end the transition
+        or motion.
+        """
+        now = time.perf_counter()
+        if self.outgoing is None:
+            if now - self.motionStart >= self.motionDuration:
+                self.motionDuration = 0.0
+                self.frametimer.stop()
+            self.update()
+            return
+        elapsed = now - self.transitionStart
+        if elapsed >= self.activeDuration:
+            self.endTransition()
+            return
+        skipped = int(elapsed / self.frameBudget) - self.paintedFrames - self.skippedFrames
+        if skipped > 0:
+            self.skippedFrames += skipped
+            if self.metrics:
+                self.metrics.inc("transition-frames-skipped", skipped)
+        self.update()
+
+    def getFrames(self):
+        """
+        Returns: List of (QImage or QPixmap, delay in milliseconds) if an
+        animation is shown and its frames have been decoded, otherwise None.
+        """
+        return self.animationFrames
+
+    def startAnimation(self):
+        """
+        Play the shown animation from its first frame, once its frames have
+        been decoded in the background.
+        """
+        self.frameIndex = 0
+        self.animationFrames = None
+        self.animtimer.stop()
+        img = self.image
+        if (
+            not img or img.contents != "animation" or img.placeholder or img.getQImage() is None
+            or not self.isVisible()
+        ):
+            return
+        with self.framesRequested:
+            if img is not self.framesLoading:
+                # replaces any animation not taken up yet
+                self.framesRequest = img
+                self.framesRequested.notify()
+        if self.frameloader is None:
+            self.frameloader = threading.Thread(target=self.loadFrames, daemon=True)
+            self.frameloader.start()
+
+    def loadFrames(self):
+        """
+        Worker that decodes the frames of requested animations one at a time,
+        giving up on an animation as soon as another image is shown.
+        """
+        while True:
+            with self.framesRequested:
+                self.framesRequested.wait_for(lambda: self.framesRequest is not None)
+                img, self.framesRequest = self.framesRequest, None
+                self.framesLoading = img
+            frames = img.readFrames(cancelled=lambda: img is not self.image)
+            with self.framesRequested:
+                self.framesLoading = None
+            self.framesLoaded.emit(img, frames)
+
+    def setFrames(self, img, frames):
+        """
+        Start playing an animation whose frames have been decoded, unless
+        another image is shown by now.
+        """
+        if img is not self.image or not self.isVisible():
+            return
+        if not frames:
+            print("Error: failed to load animation:", os.path.join(*img.path))
+            return
+        self.animationFrames = frames
+        if len(frames) > 1:
+            self.animtimer.start(frames[0][1])
+
+    def nextFrame(self):
+        """
+        Advance to the next frame of the animation, looping at the end.
+        """
+        frames = self.getFrames()
+        if frames and len(frames) > 1:
+            self.frameIndex = (self.frameIndex + 1) % len(frames)
+            self.animtimer.start(frames[self.frameIndex][1])
+            self.update()
+
+    def startVideo(self):
+        """
+        Play the shown video from the start, or stop playing if no video is shown.
+        """
+        self.stopVideo()
+        img = self.image
+        if img and img.contents == "video" and img.getQImage() is not None and self.isVisible():
+            self.decoder = VideoDecoder(os.path.join(*img.path), img.fullsize, self.videoBuffer)
+            self.decoder.start()
+            self.videoDropped = 0
+            self.videotimer.start(int(1000 / (img.fps or 25.0)))
+
+    def stopVideo(self):
+        """
+        Stop playing, leaving the decoder thread to exit.
+        """
+        self.videotimer.stop()
+        if self.decoder is not None:
+            self.decoder.stop()
+            self.decoder = None
+        self.videoFrame = None
+
+    def videoTick(self):
+        """
+        Show the video frame due now, if it has been decoded.
+        """
+        ring = self.decoder.ring
+        frame = ring.take(self.decoder.position())
+        if ring.dropped != self.videoDropped:
+            if self.metrics:
+                self.metrics.inc("video-frames-dropped", ring.dropped - self.videoDropped)
+            self.videoDropped = ring.dropped
+        if frame is not None:
+            self.videoFrame = frame
+            self.update()
+        elif not self.decoder.is_alive():
+            print("Error: video playback stopped:", self.decoder.error)
+            self.videotimer.stop()
+
+    def showEvent(self, event):
+        """
+        Resume a paused animation or motion, or restart a video.
+        """
+        frames = self.getFrames()
+        if frames is None:
+            self.startAnimation()
+        elif len(frames) > 1 and not self.animtimer.isActive():
+            self.animtimer.start(frames[self.frameIndex % len(frames)][1])
+        if self.decoder is None:
+            self.startVideo()
+        self.startMotion()
+
+    def hideEvent(self, event):
+        """
+        Drop the animation frames, end any transition, and stop the video and
+        motion while hidden.
+        """
+        self.animtimer.stop()
+        self.animationFrames = None
+        self.stopVideo()
+        self.frametimer.stop()
+        self.outgoing = None
+
+    def endTransition(self):
+        """
+        Show the new image as is, or carry on with its motion.
+        """
+        self.outgoing = None
+        self.startMotion()
+        self.update()
+
+    def startMotion(self):
+        """
+        Repaint the panning and zooming image whenever the motion has moved by
+        about a pixel, but no more often than the frame budget allows.
+        """
+        pixmap = self.getPixmap()
+        remaining = self.motionStart + self.motionDuration - time.perf_counter()
+        if pixmap is None or remaining <= 0 or not self.isVisible():
+            self.frametimer.stop()
+            return
+        travel = (self.motionZoom - 1.0) * max(self.width(), self.height())
+        interval = max(self.frameBudget, self.motionDuration / max(1.0, travel))
+        self.frametimer.start(int(1000 * interval))
+
+    def getMotionSource(self, pixmap, now):
+        """
+        Returns: QRectF of pixmap shown at time now while the image pans and
+        zooms, or None if it is not moving.
+        """
+        if not self.motionDuration:
+            return None
+        w, h = self.width(), self.height()
+        progress = max(0.0, min(1.0, (now - self.motionStart) / self.motionDuration))
+        # zoom out to the regular crop, which the next transition starts from
+        zoom = self.motionZoom + (1.0 - self.motionZoom) * progress
+        sw, sh = w / zoom, h / zoom
+        ax, ay = self.motionAnchors[self.motionCount % len(self.motionAnchors)]
+        nx, ny = max(0, (pixmap.width() - w) // 2), max(0, (pixmap.height() - h) // 2)
+        return QRectF(nx + (w - sw) * ax, ny + (h - sh) * ay, sw, sh)
+
+    def setDarkness(self, darkness):
+        """
+        Change by how much the image is darkened.
+
+        Args:
+            darkness: Alpha of black painted over the image, 0x00-0xff where
+                0xff is black.
+        """
+        if darkness != self.darkenBy:
+            self.darkenBy = darkness
+            self.pixmapKey = None
+            self.update()
+
+    def makePixmap(self, img):
+        """
+        Convert an image to the screen format and darken it.
+
+        Args:
+            img: QImage, or QPixmap which is not changed.
+
+        Returns: QPixmap of the same size.
+        """
+        pixmap = QPixmap(img) if isinstance(img, QPixmap) else QPixmap.fromImage(img)
+        if self.darkenBy:
+            qp = QPainter(pixmap)
+            qp.fillRect(pixmap.rect(), QColor(0x00, 0x00, 0x00, self.darkenBy))
+            qp.end()
+        return pixmap
+
+    def getFramePixmap(self, frames):
+        """
+        Returns: Composited QPixmap of the current frame of an animation.
+        """
+        index = self.frameIndex % len(frames)
+        frame, delay = frames[index]
+        if not isinstance(frame, QPixmap):
+            # the pixmap replaces the decoded frame rather than duplicating it
+            frame = QPixmap.fromImage(frame)
+            frames[index] = (frame, delay)
+        width, height = self.image.fullsize
+        if frame.width() >= width and not self.darkenBy:
+            return frame
+        key = ("frame", frame.cacheKey(), self.darkenBy)
+        if key != self.pixmapKey:
+            if frame.width() < width:
+                # frames were kept small to stay within the frame budget
+                frame = frame.scaled(width, height)
+            self.pixmap = self.makePixmap(frame)
+            self.pixmapKey = key
+        return self.pixmap
+
+    def getPixmap(self):
+        """
+        Returns: Composited QPixmap of the current image, animation frame or
+        video frame, or None if there is no image data to show.
+        """
+        frames = self.getFrames()
+        if frames:
+            return self.getFramePixmap(frames)
+        if self.videoFrame is not None:
+            img = self.videoFrame[1]
+        else:
+            img = self.image.getQImage() if self.image else None
+        if not img:
+            self.pixmap = self.pixmapKey = None
+            return None
+        key = (img.cacheKey(), self.darkenBy)
+        if key != self.pixmapKey:
+            self.pixmap = self.makePixmap(img)
+            self.pixmapKey = key
+        return self.pixmap
+
+    def drawTransition(self, qp, pixmap, progress, source=None):
+        """
+        Paint one transition frame from the outgoing pixmap to pixmap.
+
+        Args:
+            qp: Active QPainter.
+            pixmap: Pixmap of the new image.
+            progress: Fraction of the transition done, 0.0 to 1.0.
+            source: QRectF of pixmap to show if the new image is moving.
+        """
+        w, h = self.width(), self.height()
+        old = self.outgoing
+        ox, oy = max(0, (old.width() - w) // 2), max(0, (old.height() - h) // 2)
+        nx, ny = max(0, (pixmap.width() - w) // 2), max(0, (pixmap.height() - h) // 2)
+        if self.transition == "slide":
+            # the new image pushes the old one out to the left
+            offset = int(progress * w)
+            qp.drawPixmap(QRect(0, 0, w - offset, h), old, QRect(ox + offset, oy, w - offset, h))
+            qp.drawPixmap(QRect(w - offset, 0, offset, h), pixmap, QRect(nx, ny, offset, h))
+            return
+        qp.drawPixmap(QRect(0, 0, w, h), old, QRect(ox, oy, w, h))
+        qp.setOpacity(progress)
+        if source is not None:
+            qp.drawPixmap(QRectF(0, 0, w, h), pixmap, source)
+        else:
+            qp.drawPixmap(QRect(0, 0, w, h), pixmap, QRect(nx, ny, w, h))
+        qp.setOpacity(1.0)
+
+    def measureFrame(self, seconds):
+        """
+        Track the cost of the frames of the current transition or motion, and
+        switch to hard cuts for hardCutCooldown seconds if they cannot be
+        painted within the frame budget.
+
+        Args:
+            seconds: Time taken to paint the last frame.
+        """
+        self.paintedFrames += 1
+        self.frameTime = seconds if self.paintedFrames == 1 else 0.8 * self.frameTime + 0.2 * seconds
+        if self.metrics:
+            self.metrics.observe("transition-frame", seconds)
+        if self.paintedFrames >= self.minFrames and self.frameTime > self.frameBudget:
+            print("Warning: transition frames take {:.0f} ms, using hard cuts for {:.0f} s".format(
+                1000 * self.frameTime, self.hardCutCooldown))
+            self.hardCutUntil = time.perf_counter() + self.hardCutCooldown
+            if self.metrics:
+                self.metrics.inc("transition-fallback")
+            self.motionDuration = 0.0
+            self.endTransition()
 
     def paintEvent(self, event):
         """
-        Image is rescaled to cover frame as snugly as possible, then drawn centered.
+        Image is drawn centered, cropped to the frame. Only the region that
+        needs repainting is copied, except during transitions and while the
+        image pans and zooms.
 
         Args:
             event: Qt event.
         """
-        img = self.image.getQImage() if self.image else None
+        t0 = time.perf_counter()
+        pixmap = self.getPixmap()
         qp = QPainter()
         qp.begin(self)
-        if img:
-            w, h = self.width(), self.height()
-            #img = img.scaled(w, h, aspectRatioMode=Qt.KeepAspectRatioByExpanding)
-            imw, imh = img.width(), img.height()
-            ix = max(0, (imw - w) / 2)
-            iy = max(0, (imh - h) / 2)
-            qp.drawImage(0, 0, img, ix, iy)
-            brush1 = QBrush(QColor(0x00, 0x00, 0x00, self.darkenBy), Qt.SolidPattern)
-            qp.fillRect(0, 0, w, h, brush1)
+        source = self.getMotionSource(pixmap, t0) if pixmap else None
+        if pixmap and self.outgoing is not None:
+            progress = (t0 - self.transitionStart) / self.activeDuration
+            self.drawTransition(qp, pixmap, max(0.0, min(1.0, progress)), source)
+            qp.end()
+            self.measureFrame(time.perf_counter() - t0)
+            return
+        if source is not None:
+            qp.drawPixmap(QRectF(0, 0, self.width(), self.height()), pixmap, source)
+            qp.end()
+            self.measureFrame(time.perf_counter() - t0)
+            return
+        if pixmap:
+            ix = max(0, (pixmap.width() - self.width()) // 2)
+            iy = max(0, (pixmap.height() - self.height()) // 2)
+            for rect in event.region().rects():
+                qp.drawPixmap(rect, pixmap, rect.translated(ix, iy))
         else:
             qp.setPen(QColor(168, 34, 3))
             qp.setFont(QFont('Decorative', 10))
-            qp.drawText(event.rect(), Qt.AlignCenter, "nothing to show...")
+            text = "loading..." if self.image and self.image.placeholder else "nothing to show..."
+            qp.drawText(QRect(0, 0, self.width(), self.height()), Qt.AlignCenter, text)
         qp.end()
-
-
+        if self.metrics:
+            self.metrics.observe("paint", time.perf_counter() - t0)
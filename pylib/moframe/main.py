@@ -38,6 +38,7 @@ def main():
         if os.path.isfile(cfgpath):
             with open(cfgpath, "r") as fh:
                 cfg = hjson.load(fh)
+            cfg.setdefault("data-dir", os.path.join(os.path.dirname(os.path.abspath(cfgpath)), ".moframe"))
         cmdpath = os.path.join(path, "..", "mocommands.py")
         if os.path.isfile(cmdpath):
             spec = importlib.util.spec_from_file_location("mocommands", cmdpath)
@@ -0,0 +1,269 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# upper bounds of latency histogram buckets, in seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets, cheap enough to update on every
+    decode, lock acquisition or paint.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        """
+        Record one duration.
+        """
+        ii = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[ii] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        """
+        Returns: Upper bound of the bucket holding the q-quantile in seconds,
+        infinity if above the largest bucket, or 0.0 if empty.
+        """
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        total = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            total += n
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        """
+        Returns: Human readable count, mean, median and 95th percentile.
+        """
+        count = self.count
+        return "{} x {:.1f} ms avg, p50 <= {:.1f} ms, p95 <= {:.1f} ms".format(
+            count, 1000.0 * self.sum / count if count else 0.0,
+            1000.0 * self.quantile(0.5), 1000.0 * self.quantile(0.95))
+
+
+class TimedLock(object):
+    """
+    Drop-in replacement for threading.Lock, also usable with
+    threading.Condition, that records how long contended acquisitions waited.
+    """
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - t0)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Metrics(object):
+    """
+    Named counters, latency histograms and gauges of one component. Gauges are
+    functions evaluated when the metrics are read.
+    """
+    def __init__(self, prefix="moframe"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name):
+        """
+        Returns: Histogram of the given name, created on first use.
+        """
+        hist = self.histograms.get(name)
+        if hist is None:
+            with self.lock:
+                hist = self.histograms.setdefault(name, Histogram())
+        return hist
+
+    def observe(self, name, seconds):
+        """
+        Record a duration in the named histogram.
+        """
+        self.histogram(name).observe(seconds)
+
+    def inc(self, name, amount=1):
+        """
+        Increase the named counter.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, fn):
+        """
+        Register a gauge.
+
+        Args:
+            name: Name of gauge.
+            fn: Function without arguments returning the current value.
+        """
+        self.gauges[name] = fn
+
+    def readGauges(self):
+        """
+        Returns: Dictionary of current gauge values, leaving out failing ones.
+        """
+        values = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                values[name] = fn()
+            except Exception:
+                pass
+        return values
+
+    def getStatus(self):
+        """
+        Returns: Dictionary of human readable metrics.
+        """
+        status = {}
+        for name, hist in sorted(self.histograms.items()):
+            status["time-" + name] = hist.summary()
+        for name, value in sorted(self.counters.items()):
+            status["count-" + name] = str(value)
+        for name, value in sorted(self.readGauges().items()):
+            status[name] = "{:.3g}".format(value) if isinstance(value, float) else str(value)
+        return status
+
+    def logLine(self):
+        """
+        Returns: Single line summary of the metrics, for periodic logging.
+        """
+        parts = []
+        for name, hist in sorted(self.histograms.items()):
+            if hist.count:
+                parts.append("{}={}x{:.1f}ms/p95<={:.1f}ms".format(
+                    name, hist.count, 1000.0 * hist.sum / hist.count, 1000.0 * hist.quantile(0.95)))
+        for name, value in sorted(self.counters.items()):
+            parts.append("{}={}".format(name, value))
+        for name, value in sorted(self.readGauges().items()):
+            parts.append("{}={:.3g}".format(name, value) if isinstance(value, float) else "{}={}".format(name, value))
+        return "[{}] {}".format(self.prefix, " ".join(parts))
+
+    def toJson(self):
+        """
+        Returns: Dictionary of raw metric values, suitable for json.dumps.
+        """
+        histograms = {}
+        for name, hist in self.histograms.items():
+            with hist.lock:
+                histograms[name] = {
+                    "buckets": list(hist.buckets), "counts": list(hist.counts),
+                    "count": hist.count, "sum": hist.sum,
+                }
+        with self.lock:
+            counters = dict(self.counters)
+        return {"histograms": histograms, "counters": counters, "gauges": self.readGauges()}
+
+    def toPrometheus(self):
+        """
+        Returns: Metrics in the Prometheus text exposition format.
+        """
+        def metricName(name, suffix=""):
+            return "{}_{}{}".format(self.prefix, name.replace("-", "_"), suffix)
+
+        lines = []
+        data = self.toJson()
+        for name, hist in sorted(data["histograms"].items()):
+            base = metricName(name, "_seconds")
+            lines.append("# TYPE {} histogram".format(base))
+            total = 0
+            for bound, n in zip(hist["buckets"] + ["+Inf"], hist["counts"]):
+                total += n
+                lines.append('{}_bucket{{le="{}"}} {}'.format(base, bound, total))
+            lines.append("{}_sum {}".format(base, hist["sum"]))
+            lines.append("{}_count {}".format(base, hist["count"]))
+        for name, value in sorted(data["counters"].items()):
+            lines.append("# TYPE {} counter".format(metricName(name, "_total")))
+            lines.append("{} {}".format(metricName(name, "_total"), value))
+        for name, value in sorted(data["gauges"].items()):
+            lines.append("# TYPE {} gauge".format(metricName(name)))
+            lines.append("{} {}".format(metricName(name), float(value)))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer(threading.Thread):
+    """
+    Read-only HTTP endpoint on localhost serving metrics as Prometheus text on
+    /metrics and as JSON on /metrics.json.
+    """
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        """
+        Args:
+            metrics: Metrics to serve.
+            port: TCP port to listen on.
+            host: Address to bind to.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        metricsRef = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metricsRef.toPrometheus().encode("utf-8")
+                    ctype = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metricsRef.toJson(), sort_keys=True).encode("utf-8")
+                    ctype = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        """
+        Stop serving and close the socket.
+        """
+        self.server.shutdown()
+        self.server.server_close()
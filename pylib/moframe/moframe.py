@@ -367,6 +367,8 @@ QLabel {
         centralw = self.centralWidget()
 
         for widget_config in cfg.get("widgets", []):
+            if "data-dir" in cfg:
+                widget_config.setdefault("data-dir", cfg["data-dir"])
             if widget_config["type"] == "Gallery":
                 from moframe.gallerywidget import GalleryWidget
                 ww = GalleryWidget(centralw, cfg=widget_config)
@@ -385,6 +387,11 @@ QLabel {
         layout.setContentsMargins(0, 0, 0, 0)
         for ww in self.central_widgets:
             layout.addWidget(ww)
+        self.awayDarkness = None
+        for ww in self.central_widgets:
+            if hasattr(ww, "presenceChanged") and ww.config.get("motion-sense", False):
+                darkness = ww.config.get("motion-darkness", 0xff)
+                ww.presenceChanged.connect(lambda present, darkness=darkness: self.presenceChanged(present, darkness))
 
         self.menu = MOFrameMenu(self)
         self.controls = MOFrameControls(self)
@@ -578,8 +585,25 @@ QLabel {
         """
         for ww in self.central_widgets:
             if hasattr(ww, "photoframe"):
-                ww.photoframe.darkenBy = darkness
-                ww.repaint()
+                ww.photoframe.setDarkness(darkness)
+
+    def presenceChanged(self, present, darkness=0xff):
+        """
+        Go dark and pause the current widget when nobody is around, and restore
+        both when somebody comes back.
+
+        Args:
+            present: True iff motion was seen recently.
+            darkness: Darkness to use while nobody is present.
+        """
+        if not present and self.awayDarkness is None:
+            self.awayDarkness = self.getDarkness()
+            self.setDarkness(darkness)
+            self.currentWidget().pause()
+        elif present and self.awayDarkness is not None:
+            self.setDarkness(self.awayDarkness)
+            self.awayDarkness = None
+            self.currentWidget().start()
 
     def getDarkness(self):
         """
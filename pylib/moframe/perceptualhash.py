@@ -0,0 +1,202 @@
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+HASH_SIZE = 32
+# stored with the index, increase when hashes change so that they are recomputed
+HASH_VERSION = 2
+MASK = (1 << 64) - 1
+DCT = {}
+POPCOUNT = None
+
+
+def dctMatrix(n):
+    """
+    Returns: Orthonormal DCT-II matrix of size n x n.
+    """
+    if n in DCT:
+        return DCT[n]
+    k = numpy.arange(n).reshape(-1, 1)
+    m = numpy.cos(numpy.pi * (2 * numpy.arange(n) + 1) * k / (2.0 * n)) * numpy.sqrt(2.0 / n)
+    m[0] /= numpy.sqrt(2.0)
+    DCT[n] = m.astype(numpy.float32)
+    return DCT[n]
+
+
+def grayPixels(img):
+    """
+    Args:
+        img: QImage of any size.
+
+    Returns: HASH_SIZE x HASH_SIZE uint8 numpy array of its luminance.
+    """
+    if (img.width(), img.height()) != (HASH_SIZE, HASH_SIZE):
+        img = img.scaled(HASH_SIZE, HASH_SIZE, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    img = img.convertToFormat(QImage.Format_Grayscale8)
+    ptr = img.constBits()
+    ptr.setsize(img.bytesPerLine() * HASH_SIZE)
+    rows = numpy.frombuffer(ptr, numpy.uint8).reshape(HASH_SIZE, img.bytesPerLine())
+    return rows[:, :HASH_SIZE].copy()
+
+
+def phashBatch(pixels):
+    """
+    Compute 64-bit DCT perceptual hashes of a batch of grayscale previews: the
+    sign pattern of the 8 x 8 lowest frequencies relative to their median.
+
+    Args:
+        pixels: N x HASH_SIZE x HASH_SIZE uint8 array.
+
+    Returns: Array of N uint64 hashes.
+    """
+    dct = dctMatrix(HASH_SIZE)
+    coeffs = numpy.matmul(numpy.matmul(dct, pixels.astype(numpy.float32)), dct.T)
+    low = coeffs[:, :8, :8].reshape(len(pixels), 64)
+    median = numpy.median(low[:, 1:], axis=1)
+    bits = numpy.packbits(low > median[:, None], axis=1)
+    return bits.view(">u8").astype(numpy.uint64).ravel()
+
+
+def hammingDistances(hashes, others):
+    """
+    Args:
+        hashes: Array of M uint64 hashes.
+        others: Array of N uint64 hashes.
+
+    Returns: M x N array of the number of differing bits.
+    """
+    global POPCOUNT
+    if POPCOUNT is None:
+        POPCOUNT = numpy.array([bin(ii).count("1") for ii in range(256)], dtype=numpy.uint8)
+    diff = numpy.bitwise_xor(hashes[:, None], others[None, :])
+    return POPCOUNT[diff.view(numpy.uint8)].reshape(diff.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+
+def toSigned(value):
+    """
+    Returns: Unsigned 64-bit hash as a signed integer, for storing in SQLite.
+    """
+    value = int(value)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class DuplicateClusters(object):
+    """
+    Clusters of near-duplicate images, e.g. burst shots and re-exports, found
+    by comparing perceptual hashes within each directory. Only files with
+    duplicates are held, so memory use is proportional to their number.
+
+    Not thread-safe, callers must serialize access.
+    """
+    chunk = 256
+
+    def __init__(self, threshold=8):
+        """
+        Args:
+            threshold: Maximum number of differing hash bits of near-duplicates.
+        """
+        self.threshold = threshold
+        self.clusterOf = {}
+        self.members = {}
+
+    @classmethod
+    def findClusters(cls, fileids, hashes, threshold):
+        """
+        Single-linkage clustering of hashes by Hamming distance.
+
+        Args:
+            fileids: List of file ids.
+            hashes: Array of their uint64 hashes.
+            threshold: Maximum number of differing bits within a cluster.
+
+        Returns: List of clusters with more than one member, as lists of file ids.
+        """
+        parent = list(range(len(fileids)))
+
+        def find(ii):
+            while parent[ii] != ii:
+                parent[ii] = parent[parent[ii]]
+                ii = parent[ii]
+            return ii
+
+        for start in range(0, len(fileids), cls.chunk):
+            dist = hammingDistances(hashes[start:start + cls.chunk], hashes)
+            for ii, jj in zip(*numpy.nonzero(dist <= threshold)):
+                ii += start
+                if ii < jj:
+                    parent[find(ii)] = find(jj)
+        groups = {}
+        for ii, fileid in enumerate(fileids):
+            groups.setdefault(find(ii), []).append(fileid)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def cluster(self, fileids, hashes):
+        """
+        Find the clusters among a group of files without modifying anything, so
+        that it can be called without holding the lock protecting this object.
+
+        Args:
+            fileids: List of file ids.
+            hashes: List of their signed 64-bit hashes as stored.
+
+        Returns: List of clusters, as lists of file ids.
+        """
+        if len(fileids) < 2:
+            return []
+        hashes = numpy.array([h & MASK for h in hashes], dtype=numpy.uint64)
+        return self.findClusters(fileids, hashes, self.threshold)
+
+    def setGroup(self, fileids, clusters):
+        """
+        Replace the clusters among a group of files, typically one directory.
+
+        Args:
+            fileids: List of file ids in the group.
+            clusters: Clusters within the group as returned by cluster.
+        """
+        for fileid in fileids:
+            self.discard(fileid)
+        for cluster in clusters:
+            key = min(cluster)
+            self.members[key] = cluster
+            for fileid in cluster:
+                self.clusterOf[fileid] = key
+
+    def discard(self, fileid):
+        """
+        Remove a file from its cluster, dissolving clusters left with one member.
+        """
+        key = self.clusterOf.pop(fileid, None)
+        if key is None:
+            return
+        cluster = self.members.pop(key)
+        cluster.remove(fileid)
+        if len(cluster) > 1:
+            self.members[min(cluster)] = cluster
+            for other in cluster:
+                self.clusterOf[other] = min(cluster)
+        else:
+            for other in cluster:
+                del self.clusterOf[other]
+
+    def siblings(self, fileid):
+        """
+        Returns: Other members of the file's cluster.
+        """
+        key = self.clusterOf.get(fileid)
+        if key is None:
+            return []
+        return [other for other in self.members[key] if other != fileid]
+
+    def getStatus(self):
+        """
+        Returns: Dictionary describing the clusters.
+        """
+        return {
+            "duplicates": "{} clusters of {} files".format(len(self.members), len(self.clusterOf)),
+        }
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import os.path
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtGui import QImage
+
+
+# part of every key, increase when rendering changes so that stale entries are not used
+RENDER_VERSION = 2
+
+
+class RenderCache(object):
+    """
+    On-disk cache of images already fitted to their display size, so that
+    showing an image again costs a small file read instead of a full decode.
+
+    Entries are evicted least recently used first once the byte budget is
+    exceeded. File mtimes record last use, so the order survives restarts.
+    """
+    def __init__(self, path, budget, quality=95):
+        """
+        Args:
+            path: Directory to keep cached images in.
+            budget: Maximum total size of cached files in bytes.
+            quality: JPEG quality used for opaque images.
+        """
+        self.path = path
+        self.budget = budget
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(path, exist_ok=True)
+            entries = list(os.scandir(path))
+        except OSError as e:
+            print("Error: could not open render cache:", path, e)
+            self.budget = 0
+            entries = []
+        files = []
+        for entry in entries:
+            if "." not in entry.name:
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # removed meanwhile, or not accessible
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, name, size in sorted(files):
+            if name.endswith(".tmp"):
+                self.remove(name)
+                continue
+            self.entries[name.split(".", 1)[0]] = (name, size)
+            self.total += size
+        with self.lock:
+            self.evict()
+
+    @staticmethod
+    def makeKey(path, mtime, size, targetsize):
+        """
+        Args:
+            path: Full filename of original image.
+            mtime: Modification time of original image.
+            size: Size in bytes of original image.
+            targetsize: Pixel width and height tuple of the rendered image.
+
+        Returns: String key identifying the rendered image.
+        """
+        key = "{}\0{!r}\0{}\0{}x{}\0{}".format(path, mtime, size, *targetsize, RENDER_VERSION)
+        return hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns: Cached QImage for key, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        filename = os.path.join(self.path, entry[0])
+        img = QImage(filename)
+        if img.isNull():
+            with self.lock:
+                self.misses += 1
+                self.discard(key)
+            return None
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return img
+
+    def put(self, key, img):
+        """
+        Store a rendered image in the cache.
+
+        Args:
+            key: Key from makeKey.
+            img: QImage to store.
+        """
+        if self.budget <= 0 or img is None or img.isNull():
+            return
+        if img.hasAlphaChannel():
+            name, fmt, quality = key + ".png", "PNG", -1
+        else:
+            name, fmt, quality = key + ".jpg", "JPG", self.quality
+        filename = os.path.join(self.path, name)
+        tmpname = filename + ".tmp"
+        if not img.save(tmpname, fmt, quality):
+            self.remove(os.path.basename(tmpname))
+            return
+        try:
+            os.replace(tmpname, filename)
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total -= old[1]
+                if old[0] != name:
+                    self.remove(old[0])
+            self.entries[key] = (name, size)
+            self.total += size
+            self.evict()
+
+    def discard(self, key):
+        """
+        Forget an entry. Must be called with the lock held.
+        """
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total -= entry[1]
+            self.remove(entry[0])
+
+    def evict(self):
+        """
+        Drop least recently used entries until within budget. Must be called
+        with the lock held.
+        """
+        while self.entries and self.total > self.budget:
+            name, size = self.entries.popitem(last=False)[1]
+            self.total -= size
+            self.remove(name)
+
+    def remove(self, name):
+        """
+        Delete a cache file, ignoring errors.
+        """
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def getStatus(self):
+        """
+        Returns: Dictionary describing cache usage.
+        """
+        return {
+            "render-cache": "{} hits, {} misses, {:.0f} of {:.0f} MB".format(
+                self.hits, self.misses, self.total / 1e6, self.budget / 1e6),
+        }
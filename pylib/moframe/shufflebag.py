@@ -0,0 +1,129 @@
+import random
+
+
+class ShuffleBag(object):
+    """
+    Set of items that are drawn uniformly at random, without repetition until
+    every item has been drawn once (a cycle).
+
+    Items are kept in an array where items[:pos] have been drawn in the current
+    cycle and items[pos:] have not. Drawing swaps a random undrawn item to pos,
+    removal swaps the item to the end, so add, remove and draw are all O(1).
+    """
+    def __init__(self, items=()):
+        self.items = []
+        self.index = {}
+        self.pos = 0
+        self.cycle = 0
+        self.update(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def swap(self, i, j):
+        """
+        Swap items at positions i and j.
+        """
+        items = self.items
+        if i != j:
+            items[i], items[j] = items[j], items[i]
+            self.index[items[i]] = i
+            self.index[items[j]] = j
+
+    def add(self, item, drawn=False):
+        """
+        Add item, unless already present.
+
+        Args:
+            item: Hashable item.
+            drawn: If True, the item counts as already drawn in this cycle.
+        """
+        if item in self.index:
+            return
+        self.index[item] = len(self.items)
+        self.items.append(item)
+        if drawn:
+            self.swap(self.index[item], self.pos)
+            self.pos += 1
+
+    def update(self, items):
+        """
+        Add all items as not yet drawn.
+        """
+        for item in items:
+            self.add(item)
+
+    def discard(self, item):
+        """
+        Remove item if present.
+        """
+        i = self.index.get(item)
+        if i is None:
+            return
+        if i < self.pos:
+            self.pos -= 1
+            self.swap(i, self.pos)
+            i = self.pos
+        self.swap(i, len(self.items) - 1)
+        self.items.pop()
+        del self.index[item]
+
+    def remove(self, item):
+        """
+        Remove item.
+
+        Raises:
+            KeyError: if item is not present.
+        """
+        if item not in self.index:
+            raise KeyError(item)
+        self.discard(item)
+
+    def markDrawn(self, item):
+        """
+        Move item to the drawn part of the current cycle, if it is not already.
+        """
+        i = self.index.get(item)
+        if i is not None and i >= self.pos:
+            self.swap(i, self.pos)
+            self.pos += 1
+
+    def isDrawn(self, item):
+        """
+        Returns: True iff item has been drawn in the current cycle.
+        """
+        return self.index.get(item, self.pos) < self.pos
+
+    def remaining(self):
+        """
+        Returns: Number of items not yet drawn in the current cycle.
+        """
+        return len(self.items) - self.pos
+
+    def restart(self):
+        """
+        Start a new cycle in which all items are undrawn.
+        """
+        self.pos = 0
+        self.cycle += 1
+
+    def draw(self):
+        """
+        Draw a random item not yet drawn in this cycle, starting a new cycle if
+        all items have been drawn.
+
+        Returns: An item, or None if empty.
+        """
+        if not self.items:
+            return None
+        if self.pos >= len(self.items):
+            self.restart()
+        self.swap(self.pos, random.randrange(self.pos, len(self.items)))
+        self.pos += 1
+        return self.items[self.pos - 1]
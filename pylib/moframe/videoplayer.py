@@ -0,0 +1,225 @@
+import threading
+import time
+from collections import deque
+
+from PyQt5.QtGui import QImage
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Qt 5.14 and later can show BGR pixels as decoded by OpenCV directly
+NATIVE_BGR = hasattr(QImage, "Format_BGR888")
+
+
+def fitFrame(frame, size):
+    """
+    Fit a video frame in size like GalleryObject.fit: crop the centered part
+    with the aspect ratio of size, then scale it to exactly size.
+
+    Args:
+        frame: H x W x 3 BGR numpy array as decoded by OpenCV.
+        size: Desired pixel width and height tuple.
+
+    Returns: Numpy array of the given size.
+    """
+    (width, height), (sh, sw) = size, frame.shape[:2]
+    scale = max(float(width) / sw, float(height) / sh)
+    cw, ch = min(sw, int(round(width / scale))), min(sh, int(round(height / scale)))
+    x, y = (sw - cw) // 2, (sh - ch) // 2
+    crop = frame[y:y + ch, x:x + cw]
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+    return cv2.resize(crop, (width, height), interpolation=interpolation)
+
+
+def toQImage(frame):
+    """
+    Wrap a BGR frame in a QImage without copying. The QImage only borrows the
+    array, so the array has to be kept alive for as long as the QImage is used.
+    On Qt without BGR support the colours of the frame are swapped in place.
+
+    Args:
+        frame: Contiguous H x W x 3 BGR numpy array.
+
+    Returns: QImage sharing the array's memory.
+    """
+    height, width = frame.shape[:2]
+    if NATIVE_BGR:
+        fmt = QImage.Format_BGR888
+    else:
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+        fmt = QImage.Format_RGB888
+    return QImage(frame.data, width, height, frame.strides[0], fmt)
+
+
+def readVideoInfo(path, size):
+    """
+    Open a video to find its length and decode its first frame as a poster.
+
+    Args:
+        path: Filename of a video.
+        size: Pixel width and height tuple to fit the poster in.
+
+    Returns: Tuple (poster QImage, source width and height, duration in seconds,
+    frames per second), or None if the video cannot be read.
+    """
+    if cv2 is None:
+        return None
+    capture = cv2.VideoCapture(path)
+    try:
+        rval, frame = capture.read()
+        if not rval or frame is None:
+            return None
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        sourcesize = (frame.shape[1], frame.shape[0])
+        frame = fitFrame(frame, size)
+        # copied so that the poster owns its pixels
+        poster = toQImage(frame).copy()
+        return poster, sourcesize, max(0.0, count / fps), fps
+    finally:
+        capture.release()
+
+
+class FrameRing(object):
+    """
+    Bounded buffer of decoded frames with presentation times, filled by one
+    decoder thread and drained by the GUI thread. The decoder blocks while the
+    ring is full; the GUI never blocks and skips frames that are already late.
+    """
+    def __init__(self, capacity=8):
+        """
+        Args:
+            capacity: Maximum number of frames held.
+        """
+        self.frames = deque()
+        self.capacity = max(1, capacity)
+        self.changed = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, pts, image, frame):
+        """
+        Add a frame, waiting for room.
+
+        Args:
+            pts: Presentation time in seconds since the start of playback.
+            image: QImage of the frame.
+            frame: Numpy array backing the QImage.
+
+        Returns: False if the ring was closed meanwhile.
+        """
+        with self.changed:
+            while len(self.frames) >= self.capacity and not self.closed:
+                self.changed.wait()
+            if self.closed:
+                return False
+            self.frames.append((pts, image, frame))
+            return True
+
+    def take(self, position):
+        """
+        Take the latest frame due at the given playback position, dropping any
+        earlier ones that were not shown in time.
+
+        Args:
+            position: Seconds since the start of playback.
+
+        Returns: Tuple (pts, QImage, numpy array), or None if no frame is due.
+        """
+        found = None
+        with self.changed:
+            while self.frames and self.frames[0][0] <= position:
+                if found is not None:
+                    self.dropped += 1
+                found = self.frames.popleft()
+            if found is not None:
+                self.changed.notify_all()
+        return found
+
+    def drop(self):
+        """
+        Count a frame the decoder skipped because it was late already.
+        """
+        with self.changed:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Wake up and stop the decoder.
+        """
+        with self.changed:
+            self.closed = True
+            self.frames.clear()
+            self.changed.notify_all()
+
+
+class VideoDecoder(threading.Thread):
+    """
+    Decodes a video on its own thread, fitting frames to the target size and
+    queueing them in a FrameRing. The video is looped until stopped. Playback
+    time starts when the decoder is created; frames that are late by then are
+    grabbed without being decoded and fitted, so a slow decoder drops frames
+    instead of playing in slow motion.
+    """
+    def __init__(self, path, size, capacity=8):
+        """
+        Args:
+            path: Filename of a video.
+            size: Pixel width and height tuple to fit frames in.
+            capacity: Number of frames to decode ahead.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.size = size
+        self.ring = FrameRing(capacity)
+        self.error = None
+        self.startTime = time.perf_counter()
+
+    def position(self):
+        """
+        Returns: Playback position in seconds.
+        """
+        return time.perf_counter() - self.startTime
+
+    def run(self):
+        capture = cv2.VideoCapture(self.path)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        index = 0
+        skipped = 0
+        try:
+            while not self.ring.closed:
+                rval = capture.grab()
+                if not rval:
+                    if index == 0:
+                        self.error = "failed to decode video"
+                        break
+                    # loop, keeping presentation times increasing
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    if not capture.grab():
+                        break
+                # skip the frame if the next one is due already, but still show
+                # about one frame a second when the decoder cannot keep up at all
+                if (index + 1) / fps < self.position() and skipped < fps:
+                    self.ring.drop()
+                    skipped += 1
+                    index += 1
+                    continue
+                rval, frame = capture.retrieve()
+                if not rval:
+                    break
+                skipped = 0
+                frame = fitFrame(frame, self.size)
+                if not self.ring.put(index / fps, toQImage(frame), frame):
+                    break
+                index += 1
+        finally:
+            capture.release()
+
+    def stop(self):
+        """
+        Stop decoding; the thread exits shortly after.
+        """
+        self.ring.close()
@@ -2,7 +2,7 @@ from PyQt5 import QtCore
 from PyQt5.QtWidgets import QVBoxLayout, QWidget, QLabel
 
 try:
-    from PyQt5.QtWebEngineWidgets import QWebEngineView
+    from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEnginePage
     USING_WEBKIT = False
 except ImportError:
     from PyQt5.QtWebKitWidgets import QWebView
@@ -11,7 +11,28 @@ except ImportError:
 from moframe.basewidget import BaseWidget
 
 
+# page lifecycle states to suspend hidden pages with, Qt 5.14 and later
+if not USING_WEBKIT and hasattr(QWebEnginePage, "LifecycleState"):
+    LIFECYCLE_STATES = {
+        "active": QWebEnginePage.LifecycleState.Active,
+        "frozen": QWebEnginePage.LifecycleState.Frozen,
+        "discarded": QWebEnginePage.LifecycleState.Discarded,
+    }
+else:
+    LIFECYCLE_STATES = None
+
+
 class WebWidget(BaseWidget):
+    """
+    Shows a web page. The browser is only created when the widget is first
+    started, suspended by the web engine's page lifecycle while paused
+    (web-pause-state "frozen" stops its scripts, "discarded" also frees the
+    page, which is reloaded when resumed), and torn down completely after being
+    paused for web-teardown-after seconds, if configured.
+    """
+    browser = None
+    paused = True
+
     def __init__(self, parent, cfg=None):
         QWidget.__init__(self, parent)
         self.config = cfg or {}
@@ -21,14 +42,55 @@ QWidget {
     font-weight: bold;
 }
         """)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.teardowntimer = QtCore.QTimer(self)
+        self.teardowntimer.setSingleShot(True)
+        self.teardowntimer.timeout.connect(self.teardown)
+
+    def createBrowser(self):
+        """
+        Create the browser and start loading web-url.
+        """
         if USING_WEBKIT:
             self.browser = QWebView(self)
         else:
             self.browser = QWebEngineView(self)
-        self.browser.setUrl(QtCore.QUrl(cfg["web-url"]))
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.addWidget(self.browser)
+        self.browser.setUrl(QtCore.QUrl(self.config["web-url"]))
+        self.layout().addWidget(self.browser)
+
+    def teardown(self):
+        """
+        Destroy the browser and its page, freeing their memory.
+        """
+        if self.browser is not None:
+            self.layout().removeWidget(self.browser)
+            self.browser.deleteLater()
+            self.browser = None
+
+    def setLifecycleState(self, name):
+        """
+        Move the page to a lifecycle state, if the web engine supports it.
+
+        Args:
+            name: "active", "frozen" or "discarded".
+        """
+        if self.browser is None or LIFECYCLE_STATES is None:
+            return
+        if name not in LIFECYCLE_STATES:
+            print("Error: unknown web-pause-state:", name)
+            return
+        page = self.browser.page()
+        state = LIFECYCLE_STATES[name]
+        if page.lifecycleState() != state:
+            page.setLifecycleState(state)
+
+    def suspend(self):
+        """
+        Suspend the page once it is hidden, as visible pages must stay active.
+        """
+        if self.paused and not self.isVisible():
+            self.setLifecycleState(self.config.get("web-pause-state", "frozen"))
 
     def buttonName(self):
         """
@@ -36,3 +98,34 @@ QWidget {
         """
         return "Web\n" + self.config.get("title", "...")
 
+    def start(self):
+        """
+        Start or resume widget, creating the browser on first use.
+        """
+        self.paused = False
+        self.teardowntimer.stop()
+        if self.browser is None:
+            self.createBrowser()
+        else:
+            self.setLifecycleState("active")
+
+    def pause(self):
+        """
+        Suspend the page, and schedule tearing it down if configured.
+        """
+        if self.paused:
+            return
+        self.paused = True
+        # widgets are hidden right after being paused
+        QtCore.QTimer.singleShot(0, self.suspend)
+        teardown = self.config.get("web-teardown-after", 0)
+        if teardown:
+            self.teardowntimer.start(int(teardown * 1000))
+
+    def stop(self):
+        """
+        Stop the widget terminally.
+        """
+        self.paused = True
+        self.teardowntimer.stop()
+        self.teardown()
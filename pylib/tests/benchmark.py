@@ -0,0 +1,281 @@
+"""
+Micro-benchmarks for the gallery pipeline, run headless against a synthetic
+photo library generated at run time. Results are written as JSON, e.g.:
+
+    QT_QPA_PLATFORM=offscreen scripts/pyrun tests.benchmark --output bench.json
+
+or from pylib with python -m tests.benchmark.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import QT_VERSION_STR, PYQT_VERSION_STR
+from PyQt5.QtGui import QColor, QImage, QLinearGradient, QPainter
+
+import cv2
+import numpy
+
+from moframe.camerawidget import CameraWidget
+from moframe.gallerymodel import GalleryModel, GalleryObject
+from moframe.imagewidget import ImageWidget
+
+
+def makeLibrary(basepath, count, size):
+    """
+    Write a synthetic photo library of gradient JPEGs and PNGs, spread over
+    nested directories, including an ignored "_" directory.
+
+    Args:
+        basepath: Directory to create the library in.
+        count: Number of images.
+        size: Pixel width and height of each image.
+    """
+    width, height = size
+    for ii in range(count):
+        img = QImage(width, height, QImage.Format_RGB32)
+        qp = QPainter(img)
+        gradient = QLinearGradient(0, 0, width, height)
+        gradient.setColorAt(0, QColor.fromHsv((ii * 37) % 360, 200, 220))
+        gradient.setColorAt(1, QColor.fromHsv((ii * 91) % 360, 160, 60))
+        qp.fillRect(0, 0, width, height, gradient)
+        qp.end()
+        root = os.path.join(basepath, "album{}".format(ii % 7), "day{}".format(ii % 3))
+        if ii % 13 == 0:
+            root = os.path.join(basepath, "_ignored")
+        os.makedirs(root, exist_ok=True)
+        ext = "png" if ii % 10 == 0 else "jpg"
+        img.save(os.path.join(root, "img{:05d}.{}".format(ii, ext)))
+
+
+def makeCameraClip(path, size, count=30):
+    """
+    Write a short moving gradient video to stand in for the camera.
+
+    Args:
+        path: Filename of the video, ".avi".
+        size: Pixel width and height of the frames.
+        count: Number of frames.
+    """
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height))
+    ramp = numpy.linspace(0, 255, width, dtype=numpy.uint8)
+    for ii in range(count):
+        frame = numpy.empty((height, width, 3), numpy.uint8)
+        frame[:] = numpy.roll(ramp, ii * 8)[None, :, None]
+        writer.write(frame)
+    writer.release()
+
+
+def measure(fn, repeat):
+    """
+    Call fn repeatedly and summarize its wall-clock time.
+
+    Returns: Dictionary of statistics in milliseconds.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(1000.0 * (time.perf_counter() - t0))
+    return {
+        "n": len(times),
+        "mean_ms": statistics.mean(times),
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "max_ms": max(times),
+    }
+
+
+def makeModel(basepath, datadir, **kwargs):
+    """
+    Returns: GalleryModel over basepath, keeping its data in datadir.
+    """
+    cfg = {
+        "photos-basepath": basepath,
+        "data-dir": datadir,
+        "target-size": [1280, 800],
+        "photos-watch": "off",
+        "render-cache-mb": 0,
+    }
+    cfg.update(kwargs)
+    return GalleryModel(cfg)
+
+
+def closeModel(model):
+    """
+    Stop the workers of a model that was driven without its own thread.
+    """
+    model.stop()
+    for worker in model.workers:
+        if worker.is_alive():
+            worker.join()
+    model.index.close()
+
+
+def waitFor(predicate, timeout=60.0):
+    """
+    Poll until predicate is True.
+
+    Returns: Seconds waited.
+    """
+    t0 = time.perf_counter()
+    while not predicate():
+        if time.perf_counter() - t0 > timeout:
+            raise RuntimeError("timed out")
+        time.sleep(0.001)
+    return time.perf_counter() - t0
+
+
+def run(args):
+    """
+    Run all benchmarks.
+
+    Returns: Dictionary of results.
+    """
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="moframe-bench-")
+    try:
+        basepath = os.path.join(workdir, "photos")
+        size = tuple(int(x) for x in args.size.split("x"))
+        t0 = time.perf_counter()
+        makeLibrary(basepath, args.images, size)
+        results["setup.make-library"] = {"n": 1, "mean_ms": 1000.0 * (time.perf_counter() - t0)}
+
+        def scan(datadir):
+            model = makeModel(basepath, os.path.join(workdir, datadir))
+            model.preloadStep = lambda: False
+            model.scanLibrary()
+            closeModel(model)
+            return model
+
+        results["model.scan.cold"] = measure(lambda: scan("cold-{}".format(time.perf_counter())), 1)
+        scan("warm")
+        results["model.scan.warm"] = measure(lambda: scan("warm"), args.repeat)
+
+        model = makeModel(basepath, os.path.join(workdir, "warm"))
+        model.preloadStep = lambda: False
+        model.scanLibrary()
+        del model.preloadStep
+        results["model.preloadStep"] = measure(model.preloadStep, model.preloadCount)
+        for worker in model.workers:
+            worker.start()
+        waitFor(lambda: len(model.upcoming) >= model.preloadCount)
+        fill = []
+        for _ in range(args.repeat):
+            with model.lock:
+                for fileid in list(model.upcoming):
+                    model.cache.discard(fileid)
+                model.upcoming.clear()
+            t0 = time.perf_counter()
+            while model.preloadStep():
+                pass
+            waitFor(lambda: len(model.upcoming) >= model.preloadCount)
+            fill.append(time.perf_counter() - t0)
+        results["model.preload-fill"] = {
+            "n": len(fill), "mean_ms": 1000.0 * statistics.mean(fill),
+            "images": model.preloadCount, "workers": len(model.workers),
+        }
+
+        model.nextImage()
+        results["model.getCurrentImage.hit"] = measure(model.getCurrentImage, args.repeat * 10)
+
+        def miss():
+            with model.lock:
+                fileid = model.getCurrentImageId()
+                model.cache.discard(fileid)
+                model.pending.pop(fileid, None)
+            model.getCurrentImage()
+        results["model.getCurrentImage.miss"] = measure(miss, args.repeat * 10)
+        closeModel(model)
+
+        path = os.path.join(basepath, "album1", "day1", "img{:05d}.jpg".format(1))
+        results["object.getQImage.jpeg"] = measure(
+            lambda: GalleryObject(os.path.split(path), fullsize=(1280, 800)).getQImage(), args.repeat)
+        full = QImage(path)
+        results["object.fit"] = measure(lambda: GalleryObject.fit(full, (1280, 800)), args.repeat)
+
+        def preview():
+            obj = GalleryObject(os.path.split(path), fullsize=(1280, 800))
+            obj.getQImage()
+            t0 = time.perf_counter()
+            obj.getQPreview()
+            return time.perf_counter() - t0
+        previews = [1000.0 * preview() for _ in range(args.repeat)]
+        results["object.getQPreview"] = {"n": len(previews), "mean_ms": statistics.mean(previews)}
+
+        cached = makeModel(basepath, os.path.join(workdir, "cached"), **{"render-cache-mb": 100})
+        cached.loadImage(*os.path.split(path))
+        results["model.loadImage.render-cache-hit"] = measure(
+            lambda: cached.loadImage(*os.path.split(path)), args.repeat)
+        closeModel(cached)
+
+        widget = ImageWidget()
+        widget.resize(1280, 800)
+        obj = GalleryObject(os.path.split(path), fullsize=(1280, 800))
+        obj.getQImage()
+        widget.setImage(obj)
+        results["widget.paintEvent"] = measure(widget.grab, args.repeat * 10)
+
+        clip = os.path.join(workdir, "camera.avi")
+        makeCameraClip(clip, (1280, 800))
+        camera = CameraWidget(None, {"camera-source": clip, "camera-source-fps": 1000, "invert": "xy"})
+        camera.resize(1280, 800)
+        # the capture mode is negotiated once the widget is shown
+        camera.show()
+        camera.start()
+        updates = []
+        for _ in range(args.repeat * 10):
+            waitFor(lambda: camera.capture.frame is not None)
+            t0 = time.perf_counter()
+            camera.update()
+            updates.append(1000.0 * (time.perf_counter() - t0))
+        camera.stop()
+        results["camera.update"] = {"n": len(updates), "mean_ms": statistics.mean(updates)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main():
+    """
+    An entrypoint.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the moframe gallery pipeline.")
+    parser.add_argument("--images", type=int, default=60, help="number of synthetic images")
+    parser.add_argument("--size", default="4000x3000", help="pixel size of synthetic images")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions per benchmark")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args, qtargs = parser.parse_known_args(sys.argv[1:])
+    app = QtWidgets.QApplication([sys.argv[0]] + qtargs)
+    report = {
+        "format": 1,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "qt": QT_VERSION_STR,
+        "pyqt": PYQT_VERSION_STR,
+        "cpus": os.cpu_count(),
+        "params": {"images": args.images, "size": args.size, "repeat": args.repeat},
+        "results": run(args),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
+    del app
+
+
+if __name__ == "__main__":
+    main()